@@ -0,0 +1,326 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) 2018 Andras Dosztal
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Measures the way from the GNS3 API to opened consoles as the lab grows,
+against a local stand-in GNS3 server (fake_gns3.py) and with a stub console
+program (stub_console.py) instead of real terminal windows.
+
+Usage: bench_console_connect.py [--nodes 10,100,1000,10000] [--latency MS]
+           [--padding BYTES] [--etag] [--stream] [--repeat N] [--max-open N]
+           [--json FILE] [--baseline FILE] [--tolerance 0.25]
+
+For every node count it reports:
+    payload  - size of the node list
+    projects - get_project (project list request)
+    nodes    - get_nodes (first node list request)
+    parse    - parse_nodes of that node list
+    refresh  - median of the background refreshes (the node list didn't change)
+    menu     - time-to-menu: from starting rcon_gns3.py to the node menu
+    warm     - time-to-menu again, drawn from the snapshot the first run saved
+    peak RSS - peak memory of the process doing the requests and parsing
+    open/s   - bulk-open throughput of console_jobs + ConsoleLauncher, for at
+               most --max-open consoles
+
+--json saves the results; --baseline compares them to a saved run, and
+the exit code is 1 if anything got worse by more than --tolerance.
+"""
+
+import argparse
+import json
+import os
+import resource
+import select
+import shlex
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, ".."))
+
+import rcon_gns3
+
+RCON_GNS3 = os.path.join(BENCH_DIR, "..", "rcon_gns3.py")
+FAKE_GNS3 = os.path.join(BENCH_DIR, "fake_gns3.py")
+STUB_CONSOLE = os.path.join(BENCH_DIR, "stub_console.py")
+MENU_PROMPT = b"Enter your choice (Enter to refresh"
+
+# Metric -> (column title, format, lower is better, ignored difference)
+METRICS = [
+    ("payload", ("payload", "%7.1fMB", True, None)),
+    ("projects", ("projects", "%7.1fms", True, 1.0)),
+    ("nodes", ("nodes", "%7.1fms", True, 1.0)),
+    ("parse", ("parse", "%7.1fms", True, 1.0)),
+    ("refresh", ("refresh", "%7.1fms", True, 1.0)),
+    ("menu", ("menu", "%7.0fms", True, 20.0)),
+    ("warm_menu", ("warm", "%7.0fms", True, 20.0)),
+    ("peak_mb", ("peak RSS", "%7.1fMB", True, 1.0)),
+    ("open_rate", ("open/s", "%9.0f", False, 5.0)),
+]
+
+
+def peak_rss_mb():
+    """
+    Returns the peak memory of this process in MB.
+    """
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        return peak / 1048576.0 # Bytes on macOS, KB elsewhere
+    return peak / 1024.0
+
+
+def timed(function, *args):
+    """
+    Returns the result of the call and how long it took in milliseconds.
+    """
+
+    start = time.time()
+    result = function(*args)
+    return result, (time.time() - start) * 1000
+
+
+def load_bench_config(config_path):
+    rcon_gns3.CONFIG.path = config_path
+    config = rcon_gns3.load_config()
+    rcon_gns3.API_CLIENT.configure(config["server"])
+    return config
+
+
+def child_fetch(config_path, repeat):
+    """
+    Measures the requests and the parsing of the rcon_gns3 functions.
+    """
+
+    config = load_bench_config(config_path)
+    ip, port = config["server"]["ip"], config["server"]["port"]
+    result = {}
+
+    projects, result["projects"] = timed(rcon_gns3.get_project, ip, port)
+    project_id = rcon_gns3.find_project_id(projects, config["project"])
+    nodes_json, result["nodes"] = timed(rcon_gns3.get_nodes, ip, port, project_id)
+    _, result["parse"] = timed(rcon_gns3.parse_nodes, nodes_json)
+    response = rcon_gns3.run_core(rcon_gns3.API_CLIENT.request(ip, port, "/v2/projects/%s/nodes" % project_id))
+    result["payload"] = len(response.body) / 1048576.0
+    del nodes_json, response
+
+    servers = rcon_gns3.configured_servers(config)
+    previous = {}
+    stream = config["server"].get("stream_nodes", False)
+    refreshes = []
+    for _ in range(repeat + 1): # The first one fills the caches
+        _, elapsed = timed(rcon_gns3.run_core,
+                           rcon_gns3.fetch_servers_console_nodes(servers, stream, previous))
+        refreshes.append(elapsed)
+    result["refresh"] = statistics.median(refreshes[1:])
+    result["peak_mb"] = peak_rss_mb()
+    return result
+
+
+def child_open(config_path, max_open):
+    """
+    Measures opening the consoles of the nodes with the stub console.
+    """
+
+    config = load_bench_config(config_path)
+    nodes, _ = rcon_gns3.run_core(rcon_gns3.fetch_servers_console_nodes(
+        rcon_gns3.configured_servers(config)))
+    jobs, failures = rcon_gns3.console_jobs(config, list(nodes)[:max_open])
+    launcher = rcon_gns3.ConsoleLauncher(int(config["console"].get(
+        "max_parallel_launches", rcon_gns3.DEFAULT_PARALLEL_LAUNCHES)))
+    failures, elapsed = timed(rcon_gns3.run_core, launcher.launch(jobs))
+    return {"opened": len(jobs) - len(failures), "failed": len(failures),
+            "open_rate": len(jobs) / (elapsed / 1000) if elapsed else 0}
+
+
+def run_child(mode, config_path, value):
+    """
+    Runs a measurement in a new process, so that the peak memory and the
+    caches of one don't affect the other, and returns its results.
+    """
+
+    output = subprocess.check_output([sys.executable, __file__, "--child", mode,
+                                      config_path, str(value)])
+    return json.loads(output.decode("utf-8").splitlines()[-1])
+
+
+def time_to_menu(config_path, timeout=300):
+    """
+    Starts rcon_gns3.py, chooses "Connect to nodes" and returns the time in
+    milliseconds until the node menu's prompt is printed.
+    """
+
+    start = time.time()
+    process = subprocess.Popen([sys.executable, RCON_GNS3, "--config", config_path],
+                               stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                               stderr=subprocess.DEVNULL, env=dict(os.environ, TERM="dumb"))
+    try:
+        process.stdin.write(b"1\n")
+        process.stdin.flush()
+        output = b""
+        while MENU_PROMPT not in output:
+            remaining = start + timeout - time.time()
+            if remaining <= 0 or not select.select([process.stdout], [], [], remaining)[0]:
+                raise RuntimeError("The node menu didn't show up in %d seconds" % timeout)
+            data = os.read(process.stdout.fileno(), 65536)
+            if not data:
+                raise RuntimeError("rcon_gns3.py exited before showing the node menu")
+            output = output[-len(MENU_PROMPT):] + data
+        return (time.time() - start) * 1000
+    finally:
+        process.kill()
+        process.wait()
+
+
+def start_fake_gns3(args, count):
+    """
+    Starts fake_gns3.py with "count" nodes and returns the process and its port.
+    """
+
+    command = [sys.executable, FAKE_GNS3, "--port", "0", "--nodes", str(count),
+               "--padding", str(args.padding), "--latency", str(args.latency)]
+    if args.etag:
+        command.append("--etag")
+    process = subprocess.Popen(command, stdout=subprocess.PIPE)
+    line = process.stdout.readline().decode("ascii")
+    if not line.startswith("listening on"):
+        process.kill()
+        raise RuntimeError("fake_gns3.py didn't start")
+    return process, int(line.split()[-1])
+
+
+def write_bench_config(path, port, args):
+    """
+    Writes a config that uses the fake server and the stub console.
+    """
+
+    stub = "%s -S %s %%h %%p" % (shlex.quote(sys.executable), shlex.quote(STUB_CONSOLE))
+    config = {"server": {"ip": "127.0.0.1", "port": str(port), "stream_nodes": args.stream},
+              "project": "bench",
+              "console": {"telnet_selected": "Custom", "telnet_custom": stub,
+                          "vnc_selected": "Custom", "vnc_custom": stub,
+                          "probe_timeout": 0}}
+    with open(path, "w") as config_file:
+        json.dump(config, config_file, indent=4)
+
+
+def bench(args, count):
+    """
+    Runs every measurement for one node count.
+    """
+
+    fake, port = start_fake_gns3(args, count)
+    handle, config_path = tempfile.mkstemp(suffix=".json")
+    os.close(handle)
+    # A snapshot of its own, so the first menu starts cold and the user's isn't touched
+    snapshot_path = config_path + ".snapshot"
+    os.environ["RCON_GNS3_SNAPSHOT"] = snapshot_path
+    try:
+        write_bench_config(config_path, port, args)
+        result = {"count": count}
+        result.update(run_child("fetch", config_path, args.repeat))
+        if os.path.exists(snapshot_path):
+            os.remove(snapshot_path)
+        result["menu"] = time_to_menu(config_path)
+        result["warm_menu"] = time_to_menu(config_path)
+        result.update(run_child("open", config_path, args.max_open))
+        return result
+    finally:
+        os.remove(config_path)
+        if os.path.exists(snapshot_path):
+            os.remove(snapshot_path)
+        fake.kill()
+        fake.wait()
+
+
+def print_row(result):
+    cells = ["%8d" % result["count"]]
+    for key, (_, fmt, _, _) in METRICS:
+        cells.append(fmt % result[key] if result.get(key) is not None else " " * 9)
+    print(" ".join(cells))
+
+
+def regressions(results, baseline, tolerance):
+    """
+    Returns the descriptions of the metrics that got worse compared to the
+    baseline by more than the tolerance (ignoring tiny differences).
+    """
+
+    found = []
+    baseline = dict((result["count"], result) for result in baseline)
+    for result in results:
+        old = baseline.get(result["count"])
+        if not old:
+            continue
+        for key, (title, _, lower_is_better, ignored) in METRICS:
+            if ignored is None or result.get(key) is None or old.get(key) is None:
+                continue
+            new_value, old_value = result[key], old[key]
+            if abs(new_value - old_value) < ignored:
+                continue
+            if (lower_is_better and new_value > old_value * (1 + tolerance)) \
+            or (not lower_is_better and new_value < old_value / (1 + tolerance)):
+                found.append("%d nodes: %s %.1f -> %.1f" % (result["count"], title,
+                                                           old_value, new_value))
+    return found
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="rcon_gns3 benchmark with a fake GNS3 server")
+    parser.add_argument("--nodes", default="10,100,1000,10000", help="comma-separated node counts")
+    parser.add_argument("--latency", type=float, default=0, help="delay of the fake server in ms")
+    parser.add_argument("--padding", type=int, default=0, help="extra payload bytes per node")
+    parser.add_argument("--etag", action="store_true", help="fake server supports conditional requests")
+    parser.add_argument("--stream", action="store_true", help="use stream_nodes")
+    parser.add_argument("--repeat", type=int, default=10, help="number of timed refreshes")
+    parser.add_argument("--max-open", type=int, default=1000, help="most consoles to open")
+    parser.add_argument("--json", help="save the results to this file")
+    parser.add_argument("--baseline", help="compare to the results saved earlier")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown (0.25 = 25%%)")
+    args = parser.parse_args(argv)
+
+    print(" ".join(["%8s" % "nodes"] + ["%9s" % title for _, (title, _, _, _) in METRICS]))
+    results = []
+    for count in [int(count) for count in args.nodes.split(",")]:
+        result = bench(args, count)
+        results.append(result)
+        print_row(result)
+        sys.stdout.flush()
+
+    if args.json:
+        with open(args.json, "w") as results_file:
+            json.dump(results, results_file, indent=4)
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            found = regressions(results, json.load(baseline_file), args.tolerance)
+        for description in found:
+            print("Regression: %s" % description)
+        return 1 if found else 0
+    return 0
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 5 and sys.argv[1] == "--child":
+        if sys.argv[2] == "fetch":
+            print(json.dumps(child_fetch(sys.argv[3], int(sys.argv[4]))))
+        else:
+            print(json.dumps(child_open(sys.argv[3], int(sys.argv[4]))))
+    else:
+        sys.exit(main(sys.argv[1:]))
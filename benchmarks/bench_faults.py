@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) 2018 Andras Dosztal
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Checks how the GNS3 client copes with a failing server, against the
+fault-injecting stand-in GNS3 server (fake_gns3.py):
+
+    flaky      - 20% of the answers are 503 and 10% are dropped: compares
+                 the failed requests without and with retries
+    coalescing - concurrent identical requests reach the server once
+    outage     - the server stops answering: after a few timeouts the
+                 circuit opens and the requests fail at once
+    recovery   - the server is back: the trial request closes the circuit
+    stale      - the relay keeps serving the last node list during the outage
+
+Usage: bench_faults.py [--requests N] [--seed S]
+
+Every check prints PASS or FAIL; the exit code is 1 if any failed.
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, ".."))
+
+from fake_gns3 import FakeGNS3, start_server
+from rcon_gns3_async import API_CLIENT, CircuitOpenError, GNS3APIError, GNS3Client, GNS3Relay, \
+    run_core
+
+
+class Checks(object):
+    """
+    Collects the results of the checks.
+    """
+
+    def __init__(self):
+        self.failed = 0
+
+    def check(self, name, passed, details):
+        print("%-4s %-52s %s" % ("PASS" if passed else "FAIL", name, details))
+        if not passed:
+            self.failed += 1
+
+
+def fake_server(seed, **faults):
+    """
+    Starts a FakeGNS3 with 10 nodes and returns it, its server and its port.
+    """
+
+    fake = FakeGNS3(nodes=10, seed=seed, **faults)
+    server = start_server(fake)
+    return fake, server, server.server_address[1]
+
+
+def count_failures(client, port, count):
+    """
+    Sends "count" project list requests one by one; returns the number of
+    failed ones and the elapsed milliseconds.
+    """
+
+    async def run():
+        failures = 0
+        for _ in range(count):
+            try:
+                await client.request("127.0.0.1", port, "/v2/projects")
+            except GNS3APIError:
+                failures += 1
+        return failures
+
+    start = time.time()
+    failures = run_core(run())
+    return failures, (time.time() - start) * 1000
+
+
+def flaky(checks, args):
+    fake, server, port = fake_server(args.seed, error_rate=0.2, drop_rate=0.1)
+    try:
+        results = {}
+        for retries in (0, 2):
+            client = GNS3Client(1, 1, retries=retries, retry_delay=0.005,
+                                failure_threshold=args.requests + 1)
+            before = fake.requests
+            failures, elapsed = count_failures(client, port, args.requests)
+            results[retries] = (failures, fake.requests - before, elapsed)
+            run_core(close_client(client))
+    finally:
+        server.shutdown()
+        server.server_close()
+    (plain, plain_sent, _), (retried, retried_sent, elapsed) = results[0], results[2]
+    checks.check("flaky: retries hide most transient errors", retried * 5 <= max(plain, 1),
+                 "%d -> %d of %d failed, %d -> %d sent, %.0f ms" \
+                 % (plain, retried, args.requests, plain_sent, retried_sent, elapsed))
+    checks.check("flaky: retries are bounded", retried_sent <= args.requests * 3,
+                 "%d requests sent for %d" % (retried_sent, args.requests))
+
+
+def coalescing(checks, args):
+    fake, server, port = fake_server(args.seed, latency=0.2)
+    client = GNS3Client(1, 2)
+
+    async def run():
+        return await asyncio.gather(*[client.request("127.0.0.1", port, "/v2/projects") \
+                                      for _ in range(50)])
+
+    try:
+        responses = run_core(run())
+        run_core(close_client(client))
+    finally:
+        server.shutdown()
+        server.server_close()
+    checks.check("coalescing: 50 identical requests in flight",
+                 fake.requests == 1 and all(response.status == 200 for response in responses),
+                 "%d reached the server" % fake.requests)
+
+
+def outage(checks, args):
+    fake, server, port = fake_server(args.seed)
+    client = GNS3Client(1, 0.2, retries=0, failure_threshold=3)
+    try:
+        failures, _ = count_failures(client, port, 1)
+        fake.latency = 1.0 # Longer than the read timeout
+        before = fake.requests
+        failures, elapsed = count_failures(client, port, 20)
+        sent = fake.requests - before
+        breaker = client.breaker("127.0.0.1", port)
+        checks.check("outage: the circuit opens after 3 timeouts",
+                     failures == 20 and sent == 3 and not breaker.healthy(),
+                     "%d sent for 20 requests, %.0f ms" % (sent, elapsed))
+        try:
+            run_core(client.request("127.0.0.1", port, "/v2/projects"))
+            fast = False
+        except CircuitOpenError as err:
+            fast = True
+            print("     (%s)" % err.reason)
+        checks.check("outage: open circuit fails with CircuitOpenError", fast, "")
+
+        fake.latency = 0
+        breaker.opened -= breaker.pause # The pause is over
+        failures, _ = count_failures(client, port, 5)
+        checks.check("recovery: the trial request closes the circuit",
+                     failures == 0 and breaker.healthy(), "%d of 5 failed" % failures)
+    finally:
+        run_core(close_client(client))
+        server.shutdown()
+        server.server_close()
+
+
+def stale(checks, args):
+    fake, server, port = fake_server(args.seed)
+    API_CLIENT.configure({"connect_timeout": 1, "read_timeout": 0.2, "retries": 0,
+                          "failure_threshold": 2})
+    relay = GNS3Relay("127.0.0.1", port, interval=0)
+    path = "/v2/projects/%s/nodes" % fake.projects[0]["project_id"]
+    try:
+        fresh = run_core(relay.get(path))
+        fake.latency = 1.0
+        answers = [run_core(relay.get(path)) for _ in range(5)]
+    finally:
+        server.shutdown()
+        server.server_close()
+    checks.check("stale: the relay serves the last node list",
+                 all(answer["status"] == 200 and answer["body"] == fresh["body"] for answer in answers),
+                 "%d upstream requests, circuit %s" \
+                 % (relay.upstream_requests,
+                    "open" if not API_CLIENT.breaker("127.0.0.1", port).healthy() else "closed"))
+
+
+async def close_client(client):
+    client.close()
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="rcon_gns3 checks against a failing fake GNS3 server")
+    parser.add_argument("--requests", type=int, default=200, help="requests of the flaky check")
+    parser.add_argument("--seed", type=int, default=1, help="seed of the fault injection")
+    args = parser.parse_args(argv)
+
+    checks = Checks()
+    for scenario in (flaky, coalescing, outage, stale):
+        scenario(checks, args)
+    return 1 if checks.failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) 2018 Andras Dosztal
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Compares the full (json.loads + parse_nodes) and the streaming
+(iter_json_array + parse_nodes) way of parsing a node list on synthetic
+GNS3 payloads.
+
+Usage: bench_parse_nodes.py [node count ...]
+
+Every measurement runs in its own process so that the peak memory of one
+run doesn't hide the other.
+"""
+
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import rcon_gns3
+import rcon_gns3_async
+from fake_gns3 import make_node
+
+CHUNK_SIZE = 65536
+
+
+def run_full(path):
+    """
+    Current path: the whole body is read and decoded before filtering.
+    """
+
+    start = time.time()
+    with open(path, "rb") as payload:
+        nodes = rcon_gns3.parse_nodes(json.loads(payload.read().decode("utf-8")))
+    return time.time() - start, time.time() - start, len(nodes)
+
+
+def run_stream(path):
+    """
+    Streaming path: the body is read in chunks and decoded node by node.
+    """
+
+    def chunks(payload):
+        while True:
+            chunk = payload.read(CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+
+    start = time.time()
+    first = None
+    count = 0
+    with open(path, "rb") as payload:
+        for _ in rcon_gns3.iter_parsed_nodes(rcon_gns3_async.iter_json_array(chunks(payload))):
+            if first is None:
+                first = time.time() - start
+            count += 1
+    return time.time() - start, first, count
+
+
+def child(mode, path):
+    """
+    Runs one measurement and prints it as JSON for the parent process.
+    """
+
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    total, first, count = (run_full if mode == "full" else run_stream)(path)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline
+    print(json.dumps({"total": total, "first": first, "count": count, "peak_kb": peak}))
+
+
+def main(counts):
+    """
+    Generates the payloads and prints a comparison table.
+    """
+
+    print("%8s %8s %10s %12s %12s %10s" % ("nodes", "mode", "payload", "total", "first node", "peak RSS"))
+    for count in counts:
+        handle, path = tempfile.mkstemp(suffix=".json")
+        try:
+            with os.fdopen(handle, "w") as payload:
+                json.dump([make_node(i, local=False) for i in range(count)], payload)
+            size = os.path.getsize(path)
+            for mode in ("full", "stream"):
+                output = subprocess.check_output([sys.executable, __file__, "--child", mode, path])
+                result = json.loads(output.decode("utf-8"))
+                print("%8d %8s %8.1fMB %10.1fms %10.1fms %8.1fMB" % (
+                    count, mode, size / 1048576.0, result["total"] * 1000,
+                    result["first"] * 1000, result["peak_kb"] / 1024.0))
+        finally:
+            os.remove(path)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 4 and sys.argv[1] == "--child":
+        child(sys.argv[2], sys.argv[3])
+    else:
+        main([int(arg) for arg in sys.argv[1:]] or [1000, 10000])
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) 2018 Andras Dosztal
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Stand-in GNS3 server for the benchmarks: serves synthetic projects over
+the parts of the GNS3 v2 API that rcon_gns3 uses (/v2/projects and
+/v2/projects/<id>/nodes).
+
+Usage: fake_gns3.py [--port P] [--nodes N] [--projects N] [--padding BYTES]
+                    [--latency MS] [--etag] [--error-rate R] [--drop-rate R] [--seed S]
+
+--error-rate and --drop-rate inject faults: that fraction of the requests
+gets a 503 answer, or the connection is closed without an answer.
+
+The first line printed is "listening on <port>", so a parent process can
+start it with --port 0 and read the port it got.
+"""
+
+import argparse
+import hashlib
+import json
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+NODE_TYPES = ["dynamips", "qemu", "iou", "docker", "ethernet_switch", "cloud", "vpcs"]
+
+
+def make_node(i, padding=0, local=True):
+    """
+    Returns a node that looks like what the GNS3 API sends, with ports,
+    label, position, etc. that the parser has to skip. "padding" adds that
+    many bytes of node properties to make the payload bigger. The consoles
+    are on 127.0.0.1, or spread over 10.0.x.y hosts if "local" is False.
+    """
+
+    return {
+        "name": "R%d" % i,
+        "node_id": "%032x" % i,
+        "node_type": NODE_TYPES[i % len(NODE_TYPES)],
+        "console": 5000 + i % 60000,
+        "console_host": "127.0.0.1" if local else "10.0.%d.%d" % (i // 256 % 256, i % 256),
+        "console_type": "vnc" if i % 5 == 0 else "telnet",
+        "status": "started",
+        "x": i * 10, "y": i * 5, "z": 1,
+        "symbol": ":/symbols/router.svg",
+        "label": {"text": "R%d" % i, "x": 5, "y": -25, "rotation": 0,
+                  "style": "font-family: TypeWriter;font-size: 10.0;font-weight: bold;fill: #000000;fill-opacity: 1.0;"},
+        "ports": [{"name": "FastEthernet0/%d" % port, "short_name": "f0/%d" % port,
+                   "adapter_number": 0, "port_number": port, "link_type": "ethernet",
+                   "data_link_types": {"Ethernet": "DLT_EN10MB"}} for port in range(8)],
+        "properties": {"ram": 256, "image": "c7200-adventerprisek9-mz.124-24.T5.image",
+                       "slot0": "C7200-IO-FE", "idlepc": "0x606df838", "startup_config": "!" * padding},
+    }
+
+
+class FakeGNS3(object):
+    """
+    The synthetic projects and their pre-encoded responses. The first
+    project ("bench") has "nodes" nodes, the others are empty. The
+    attributes can be changed while the server runs, e.g. to simulate an
+    outage with a long latency.
+    """
+
+    def __init__(self, nodes=100, projects=1, padding=0, latency=0.0, etag=False,
+                 error_rate=0.0, drop_rate=0.0, seed=None):
+        self.latency = latency
+        self.etag = etag
+        self.error_rate = error_rate # Fraction of the requests answered with 503
+        self.drop_rate = drop_rate # Fraction of the requests left without an answer
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.projects = [{"name": "bench" if i == 0 else "project%d" % i,
+                          "project_id": "%08x-0000-0000-0000-%012x" % (i, i),
+                          "status": "opened"} for i in range(max(1, projects))]
+        self.bodies = {"/v2/projects": json.dumps(self.projects).encode("utf-8")}
+        for i, project in enumerate(self.projects):
+            project_nodes = [make_node(n, padding) for n in range(nodes)] if i == 0 else []
+            self.bodies["/v2/projects/%s/nodes" % project["project_id"]] = \
+                json.dumps(project_nodes).encode("utf-8")
+        self.etags = dict((path, '"%s"' % hashlib.sha1(body).hexdigest())
+                          for path, body in self.bodies.items())
+
+
+class FakeGNS3Handler(BaseHTTPRequestHandler):
+    """
+    Serves the FakeGNS3 of the server with keep-alive connections.
+    """
+
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True # The headers and the body are sent separately
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        fake = self.server.fake
+        fake.requests += 1
+        if fake.latency:
+            time.sleep(fake.latency)
+        fault = fake.random.random()
+        if fault < fake.drop_rate:
+            self.close_connection = True
+            return
+        if fault < fake.drop_rate + fake.error_rate:
+            self.send_response(503)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        body = fake.bodies.get(self.path)
+        if body is None:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        etag = fake.etags[self.path]
+        if fake.etag and self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        if fake.etag:
+            self.send_header("ETag", etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class FakeGNS3Server(ThreadingMixIn, HTTPServer):
+    """
+    HTTP server of a FakeGNS3, one thread per connection.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, fake):
+        HTTPServer.__init__(self, address, FakeGNS3Handler)
+        self.fake = fake
+
+    def handle_error(self, request, client_address):
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            HTTPServer.handle_error(self, request, client_address) # Clients may hang up any time
+
+
+def start_server(fake, host="127.0.0.1", port=0):
+    """
+    Serves "fake" in a background thread and returns the server; its port
+    is server.server_address[1].
+    """
+
+    server = FakeGNS3Server((host, port), fake)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Stand-in GNS3 server for benchmarks")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=3080, help="0 picks a free port")
+    parser.add_argument("--nodes", type=int, default=100, help="nodes of the \"bench\" project")
+    parser.add_argument("--projects", type=int, default=1, help="number of projects")
+    parser.add_argument("--padding", type=int, default=0, help="extra bytes per node")
+    parser.add_argument("--latency", type=float, default=0, help="delay of every answer in ms")
+    parser.add_argument("--etag", action="store_true", help="support conditional requests")
+    parser.add_argument("--error-rate", type=float, default=0, help="fraction of 503 answers")
+    parser.add_argument("--drop-rate", type=float, default=0, help="fraction of dropped requests")
+    parser.add_argument("--seed", type=int, help="seed of the fault injection")
+    args = parser.parse_args(argv)
+
+    fake = FakeGNS3(args.nodes, args.projects, args.padding, args.latency / 1000.0, args.etag,
+                    args.error_rate, args.drop_rate, args.seed)
+    server = FakeGNS3Server((args.host, args.port), fake)
+    print("listening on %d" % server.server_address[1])
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
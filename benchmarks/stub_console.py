@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) 2018 Andras Dosztal
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Stub console program for the benchmarks: takes the place of the terminal
+emulator, so opening thousands of consoles doesn't open real windows.
+
+Usage: stub_console.py [--hold SECONDS] [--fail] HOST PORT
+
+It stays alive for --hold seconds (like a console window that's open)
+and exits with 0, or with 1 right away if --fail is given.
+"""
+
+import sys
+import time
+
+
+def main(argv):
+    hold = 0.0
+    if "--hold" in argv:
+        hold = float(argv[argv.index("--hold") + 1])
+    if "--fail" in argv:
+        return 1
+    time.sleep(hold)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
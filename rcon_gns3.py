@@ -1,4 +1,4 @@
-#!/usr/bin/python
+#!/usr/bin/env python3
 #
 # Copyright (C) 2018 Andras Dosztal
 #
@@ -22,85 +22,405 @@ It's very lightweight and useful in a group project where most of the
 computers don't have enough resources to run virtualized devices.
 """
 
-from __future__ import print_function
 from time import sleep
+import argparse
+import atexit
+import codecs
+import collections
+import copy
+import errno
+import fnmatch
 import json
+import mmap
 import os
+import re
+import select
+import selectors
+import shlex
+import shutil
+import socket
+import stat
 import sys
-import urllib2
+import threading
+import time
+
+try:
+    import termios
+    import tty
+except ImportError: # Windows
+    termios = None
+try:
+    import msvcrt
+except ImportError: # Everything else
+    msvcrt = None
+
+from rcon_gns3_async import API_CLIENT, DEFAULT_PARALLEL_LAUNCHES, DEFAULT_POLL_INTERVAL, \
+    DEFAULT_PROBE_TIMEOUT, DEFAULT_RELAY_PORT, CONSOLES, PROJECTS_CACHE, ConsoleLauncher, ConsoleNode, \
+    ConsoleNodes, GNS3APIError, GNS3Relay, NodePoller, \
+    cached_nodes, configured_servers, diff_nodes, fan_out, fetch_servers_console_nodes, \
+    index_projects, known_project_ids, merge_console_nodes, remember_project_ids, \
+    TIMINGS, iter_parsed_nodes, probe_consoles, request_nodes, request_projects, run_core, \
+    server_label, servers_error, transient_error
+
+
+def default_config_path():
+    """
+    Returns the path of the config file if none was given: config.json in
+    the current directory if it exists (that's where it always was), the
+    per-user config file (see user_config_path) if that exists, otherwise
+    the config.json next to the program.
+    """
+
+    if os.path.exists("config.json"):
+        return "config.json"
+    if os.path.exists(user_config_path()):
+        return user_config_path()
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), "config.json")
+
+
+def user_config_path():
+    """
+    Returns the per-user config file: $XDG_CONFIG_HOME/rcon_gns3/config.json
+    (~/.config by default), or %APPDATA%\\rcon_gns3\\config.json on Windows.
+    """
+
+    if sys.platform.startswith("win") and "APPDATA" in os.environ:
+        base = os.environ["APPDATA"]
+    else:
+        base = os.environ.get("XDG_CONFIG_HOME") or os.path.join(os.path.expanduser("~"), ".config")
+    return os.path.join(base, "rcon_gns3", "config.json")
+
+
+class ConfigFile(object):
+    """
+    Cached access to the config file.
+
+    The parsed config is kept in memory and the file is only read again if
+    its modification time or size changed, which is checked at most every
+    "check_interval" seconds. Writes are batched: write() only updates the
+    cache, flush() saves it atomically (temporary file + rename) so a crash
+    can't leave a half-written config behind.
+    """
+
+    def __init__(self, path=None, check_interval=1.0):
+        self.path = path
+        self.check_interval = check_interval
+        self._config = None
+        self._stamp = None
+        self._checked = 0
+        self._dirty = False
+
+    def _file_stamp(self):
+        stat = os.stat(self.path)
+        return stat.st_mtime, stat.st_size
+
+    def load(self):
+        """
+        Returns a copy of the config, reading the file only if it changed.
+        """
+
+        if self.path is None:
+            self.path = default_config_path()
+        now = time.time()
+        if self._config is None or (not self._dirty and now - self._checked >= self.check_interval):
+            self._checked = now
+            stamp = self._file_stamp()
+            if stamp != self._stamp:
+                with open(self.path) as config_file:
+                    self._config = json.load(config_file)
+                self._stamp = stamp
+        return copy.deepcopy(self._config)
+
+    def write(self, new_config):
+        """
+        Replaces the config; it's saved by the next flush().
+        """
+
+        self._config = copy.deepcopy(new_config)
+        self._dirty = True
+
+    def flush(self):
+        """
+        Saves the config if it was changed.
+        """
+
+        if not self._dirty:
+            return
+        if self.path is None:
+            self.path = default_config_path()
+        save_json(self.path, self._config, indent=4, sort_keys=True)
+        self._stamp = self._file_stamp()
+        self._checked = time.time()
+        self._dirty = False
+
+
+def save_json(path, data, **json_args):
+    """
+    Writes "data" to a JSON file atomically (temporary file + rename), so a
+    crash can't leave a half-written file behind. The file keeps its
+    permissions.
+    """
+
+    directory = os.path.dirname(os.path.abspath(path))
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    try:
+        mode = stat.S_IMODE(os.stat(path).st_mode)
+    except OSError:
+        mode = None # A new file gets the usual permissions (0666 minus the umask)
+    temp_path = os.path.join(directory, ".%s.%s.tmp" % (os.path.basename(path), os.urandom(6).hex()))
+    handle = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+                     0o666 if mode is None else 0o600)
+    try:
+        with os.fdopen(handle, "w") as json_file:
+            json.dump(data, json_file, **json_args)
+            json_file.flush()
+            os.fsync(json_file.fileno())
+        if mode is not None:
+            os.chmod(temp_path, mode)
+        os.replace(temp_path, path)
+    except Exception:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+CONFIG = ConfigFile(os.environ.get("RCON_GNS3_CONFIG"))
+atexit.register(CONFIG.flush)
+
 
 def load_config():
     """
-    (Re)loads the config file.
+    (Re)loads the config file. The file is only read again if it changed.
     """
 
-    with open("config.json") as config_file:
-        config_json = json.load(config_file)
-        return config_json
+    return CONFIG.load()
 
 
 def write_config(new_config):
     """
-    Writes the modified settings to the config file
+    Writes the modified settings to the config file. The write is batched
+    with the other changes until CONFIG.flush() is called; the main menu does
+    that every time before it's drawn.
     """
-    with open("config.json", "w") as config_file:
-        json.dump(new_config, config_file, indent=4, sort_keys=True)
-        return
 
+    CONFIG.write(new_config)
 
-def get_project(gns3_ip, gns3_port):
+
+def user_cache_path(file_name):
+    """
+    Returns the path of a per-user cache file: $XDG_CACHE_HOME/rcon_gns3
+    (~/.cache by default), or %LOCALAPPDATA%\\rcon_gns3 on Windows.
     """
-    Gets all projects from the GNS3 server using GNS3 API. Quits on error.
+
+    if sys.platform.startswith("win") and "LOCALAPPDATA" in os.environ:
+        base = os.environ["LOCALAPPDATA"]
+    else:
+        base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "rcon_gns3", file_name)
+
+
+SNAPSHOT_VERSION = 1
+
+
+class SnapshotFile(object):
+    """
+    The last known Project IDs and console nodes of every server, so the
+    node menu can be drawn at once at start while the fresh node list is
+    being fetched, and the consoles can be opened even if the server can't
+    be reached. It's one compact JSON file, saved atomically like the
+    config:
+
+        {"version": 1, "servers": {"ip:port": {
+            "projects": {project name: Project ID},
+            "nodes": {project name: {"saved": time, "nodes": [[name, host, port,
+                                                               console_type, node_type, status]]}}}}}
     """
 
-    url = "http://%s:%s/v2/projects" % (gns3_ip, gns3_port)
+    def __init__(self, path=None):
+        self.path = path
+        self._servers = None
+        self._dirty = False
+
+    def _load(self):
+        if self._servers is None:
+            if self.path is None:
+                self.path = user_cache_path("snapshot.json")
+            self._servers = {}
+            try:
+                with open(self.path) as snapshot_file:
+                    data = json.load(snapshot_file)
+                if isinstance(data, dict) and data.get("version") == SNAPSHOT_VERSION:
+                    self._servers = data["servers"]
+            except (OSError, ValueError, KeyError):
+                pass # Missing or broken: starting from scratch
+        return self._servers
+
+    def projects(self, server):
+        """
+        Returns the saved project name -> Project ID dictionary of a server
+        from configured_servers.
+        """
+        return dict(self._load().get(server_label(server), {}).get("projects", {}))
+
+    def nodes(self, server):
+        """
+        Returns the saved ConsoleNodes of the server's project and the time
+        they were saved, or (None, None).
+        """
+
+        saved = self._load().get(server_label(server), {}).get("nodes", {}).get(server["project"])
+        if not saved:
+            return None, None
+        try:
+            return ConsoleNodes(ConsoleNode(*(list(fields) + [""])) for fields in saved["nodes"]), \
+                   float(saved["saved"])
+        except (KeyError, TypeError, ValueError):
+            return None, None
+
+    def save(self, server, nodes, projects):
+        """
+        Replaces the saved nodes of the server's project and the Project IDs
+        of the server; they're written by the next flush().
+        """
+
+        entry = self._load().setdefault(server_label(server), {})
+        entry["projects"] = projects
+        entry.setdefault("nodes", {})[server["project"]] = {
+            "saved": time.time(),
+            "nodes": [list(node[:6]) for node in nodes]}
+        self._dirty = True
+
+    def flush(self):
+        """
+        Writes the snapshot if it was changed.
+        """
+
+        if not self._dirty:
+            return
+        try:
+            save_json(self.path, {"version": SNAPSHOT_VERSION, "servers": self._servers},
+                      separators=(",", ":"))
+        except OSError:
+            return # Not worth an error: the snapshot only saves time
+        self._dirty = False
+
+
+SNAPSHOT = SnapshotFile(os.environ.get("RCON_GNS3_SNAPSHOT"))
+atexit.register(SNAPSHOT.flush)
+
+
+def saved_nodes(servers):
+    """
+    Loads the saved Project IDs of the servers into the cache and returns
+    the saved nodes of the servers merged (see merge_console_nodes) and the
+    time of the oldest, or (None, None) if none were saved.
+    """
+
+    server_nodes = {}
+    oldest = None
+    for server in servers:
+        remember_project_ids(server["ip"], server["port"], SNAPSHOT.projects(server))
+        nodes, saved = SNAPSHOT.nodes(server)
+        if nodes is not None:
+            server_nodes[server_label(server)] = nodes
+            oldest = min(oldest or saved, saved)
+    if not server_nodes:
+        return None, None
+    return merge_console_nodes(servers, server_nodes), oldest
+
+
+def save_nodes(servers, server_nodes):
+    """
+    Saves the {server label: ConsoleNodes} of the servers that answered,
+    with the Project IDs known of them.
+    """
+
+    for server in servers:
+        nodes = server_nodes.get(server_label(server))
+        if nodes is not None:
+            SNAPSHOT.save(server, nodes, known_project_ids(server["ip"], server["port"]))
+    SNAPSHOT.flush()
+
+
+TIMING_FORMATS = ("summary", "json", "prometheus")
+
+
+def enable_timing(report_format="summary", report_path=None):
+    """
+    Turns on timing the stages of the program (see Timings in
+    rcon_gns3_async.py). At exit the timings are written to "report_path",
+    or to stderr, in one of the TIMING_FORMATS.
+    """
+
+    if report_format not in TIMING_FORMATS:
+        report_format = "summary"
+    TIMINGS.enabled = True
+
+    def report():
+        text = TIMINGS.report(report_format)
+        if report_path:
+            with open(report_path, "w") as report_file:
+                report_file.write(text)
+        else:
+            sys.stderr.write(text)
+
+    atexit.register(report)
+
+
+def get_project(gns3_ip, gns3_port):
+    """
+    Gets all projects from the GNS3 server using GNS3 API. If the server
+    is failing, the project list fetched earlier (or the saved one, see
+    SnapshotFile) is returned instead. Returns None if there's none.
+    """
 
     try:
-        response = urllib2.urlopen(url)
-        gns3_projects = response.read()
-        gns3_projects_json = json.loads(gns3_projects)
-        return gns3_projects_json
-    except urllib2.URLError as err:
+        return run_core(request_projects(gns3_ip, gns3_port))
+    except GNS3APIError as err:
+        projects = PROJECTS_CACHE.get((gns3_ip, str(gns3_port)))
+        if projects is None:
+            projects = [{"name": name, "project_id": project_id} for name, project_id \
+                        in SNAPSHOT.projects({"ip": gns3_ip, "port": str(gns3_port)}).items()]
+        if projects and transient_error(err):
+            input("Warning: %s. Using the last known projects. Press Enter to continue." % err.reason)
+            return projects
         print("Error when connecting to GNS3 server:", err.reason)
-        raw_input("Press Enter to quit.")
-        quit()
+        input("Press Enter to continue.")
+        return None
 
 
 def find_project_id(projects_json, gns3_project_name):
     """
-    Returns the Project ID of the name project name we provided.
+    Returns the Project ID of the name project name we provided, or None if
+    there's no such project. Accepts either the project list or its index.
     """
 
-    for project in projects_json:
-        if project["name"] == gns3_project_name:
-            project_id = project["project_id"]
-            break
+    if not isinstance(projects_json, dict):
+        projects_json = index_projects(projects_json)
+    project_id = projects_json.get(gns3_project_name)
 
-    if project_id:
-        return project_id
-    else:
-        raw_input("Error: Unknown project. Press Enter to quit.")
-        quit()
+    if not project_id:
+        input("Error: Unknown project. Press Enter to continue.")
+    return project_id
 
 
 def get_nodes(gns3_ip, gns3_port, gns3_project_id):
     """
-    Gets the nodes of the selected project from the GNS3 server using
-    GNS3 API and returns the list of those. Quits on error.
+    Same as request_nodes, but if the server is failing, the node list
+    fetched earlier is returned instead. Returns None if there's none.
     """
 
-    url = "http://%s:%s/v2/projects/%s/nodes" % (gns3_ip, gns3_port, gns3_project_id)
-
     try:
-        response = urllib2.urlopen(url)
-        gns3_nodes = response.read()
-        gns3_nodes_json = json.loads(gns3_nodes)
-        return gns3_nodes_json
-
-    except urllib2.URLError as err:
+        return run_core(request_nodes(gns3_ip, gns3_port, gns3_project_id))
+    except GNS3APIError as err:
+        nodes_json = cached_nodes(gns3_ip, gns3_port, gns3_project_id)
+        if nodes_json is not None and transient_error(err):
+            input("Warning: %s. Using the last known nodes. Press Enter to continue." % err.reason)
+            return nodes_json
         print("Error when connecting to GNS3 server:", err.reason)
-        raw_input("Press Enter to quit.")
-        quit()
+        input("Press Enter to continue.")
+        return None
 
 
 def parse_nodes(nodes_json):
@@ -117,61 +437,1302 @@ def parse_nodes(nodes_json):
         - "console_host" - IP address of the GNS3 server running the node
         - "console type" - telnet / vnc
 
-    Returns a list of the nodes with lists from the properties above.
+    Returns the nodes as ConsoleNodes. "nodes_json" can be any iterable of
+    nodes, e.g. the output of rcon_gns3_async.iter_json_array.
     """
 
-    parsed_nodes_list = []
-    for node in nodes_json:
-        node_type = node["node_type"]
-        if "dynamips" in node_type or "docker" in node_type or "iou" in node_type \
-        or "qemu" in node_type or "ethernet_switch" in node_type:
-            parsed_nodes_list.append([node["name"], node["console_host"], \
-                                      node["console"], node["console_type"]])
+    with TIMINGS.timed("parse"):
+        parsed_nodes_list = ConsoleNodes(iter_parsed_nodes(nodes_json))
 
     if parsed_nodes_list:
         return parsed_nodes_list
     else:
-        raw_input("Error: There are no applicable nodes in the project! Press Enter to continue.")
+        input("Error: There are no applicable nodes in the project! Press Enter to continue.")
+
+
+def console_state(node, reachability):
+    """
+    Returns the node's console state for the node menu, based on the
+    node's status and the result of probe_consoles.
+    """
+
+    if node.status != "started":
+        return node.status
+    if (node.host, node.port) not in reachability:
+        return ""
+    latency = reachability[(node.host, node.port)]
+    if latency is None:
+        return "down"
+    return "up, %.0f ms" % (latency * 1000)
+
+
+def live_nodes(nodes, probe_timeout):
+    """
+    Probes the consoles right away and returns the nodes whose console is
+    up, plus the (name, reason) pairs of the skipped ones. If probing is
+    disabled, only the nodes that aren't started are skipped.
+    """
+
+    reachability = {}
+    if probe_timeout:
+        reachability = run_core(probe_consoles(nodes, probe_timeout))
+    alive = []
+    skipped = []
+    for node in nodes:
+        state = console_state(node, reachability)
+        if node.status != "started":
+            skipped.append((node.label, "the node is %s" % state))
+        elif state == "down":
+            skipped.append((node.label, "the console is down"))
+        else:
+            alive.append(node)
+    return alive, skipped
+
+
+def command_argv(console_cmd):
+    """
+    Turns a console command into an argument vector that can be started
+    without a shell. Shell leftovers that older custom commands may end with
+    (output redirections and "&") are dropped, the launcher takes care of
+    those. On Windows the command line is passed as is. Raises ValueError
+    if the command can't be split (e.g. a quote isn't closed).
+    """
+
+    if sys.platform.startswith("win"):
+        return console_cmd
+    argv = shlex.split(console_cmd)
+    while argv:
+        if argv[-1] == "&" or argv[-1].lstrip("012").startswith(">"): # "&", ">/dev/null", "2>&1"
+            argv.pop()
+        elif len(argv) > 1 and argv[-2].lstrip("012") in (">", ">>"): # "> /dev/null"
+            del argv[-2:]
+        else:
+            break
+    return argv
+
+
+class ConsoleTemplate(object):
+    """
+    A console command parsed once into an argument vector, in which %d, %h
+    and %p stand for the node's name, console host and console port.
+    Rendering substitutes the node's values in a single pass. As no shell is
+    involved, the values never need quoting, except on Windows where the
+    program gets a single command line.
+    """
+
+    __slots__ = ("template", "_args")
+
+    PLACEHOLDER = re.compile("%([dhp])")
+
+    def __init__(self, template):
+        self.template = template
+        if sys.platform.startswith("win"):
+            args = [template]
+        else:
+            args = command_argv(template)
+        # Every argument is split to literal text (even indexes) and
+        # placeholder letters (odd indexes).
+        self._args = [tuple(self.PLACEHOLDER.split(arg)) for arg in args]
+
+    def render(self, node):
+        """
+        Returns the argument vector (the command line on Windows) for a node.
+        """
+
+        values = {"d": node.name, "h": node.host, "p": str(node.port)}
+        if sys.platform.startswith("win"):
+            for key in values:
+                values[key] = values[key].replace('"', '\\"')
+        argv = []
+        for pieces in self._args:
+            argv.append("".join(values[piece] if i % 2 else piece \
+                                for i, piece in enumerate(pieces)))
+        if sys.platform.startswith("win"):
+            return argv[0]
+        return argv
+
+
+# Command template -> ConsoleTemplate
+TEMPLATE_CACHE = {}
+
+
+def console_template(config, console_type):
+    """
+    Returns the ConsoleTemplate of the selected telnet or VNC client, or
+    None if there's no command for it. Raises ValueError if the command
+    can't be parsed.
+    """
+
+    selected = config["console"].get("%s_selected" % console_type)
+    if selected == "Custom":
+        template = config["console"].get("%s_custom" % console_type)
+    elif console_type == "telnet":
+        template = TELNET_CMD.get(selected)
+    elif console_type == "vnc":
+        template = VNC_CMD.get(selected)
+    else:
+        template = None
+    if not template:
+        return None
+
+    if template not in TEMPLATE_CACHE:
+        TEMPLATE_CACHE[template] = ConsoleTemplate(template)
+    return TEMPLATE_CACHE[template]
+
+
+def console_jobs(config, nodes, proxy=None):
+    """
+    Renders the console commands of the nodes. Returns the (name, argv)
+    jobs for the launcher and the (name, error) pairs of the nodes that
+    don't have a usable console command. If a TelnetProxy is given, the
+    telnet consoles are opened through it.
+    """
+
+    jobs = []
+    failures = []
+    for node in nodes:
+        try:
+            template = console_template(config, node.console_type)
+        except ValueError as err:
+            failures.append((node.label, "wrong %s command: %s" % (node.console_type, err)))
+            continue
+        if template and proxy and node.console_type == "telnet":
+            try:
+                local_host, local_port = proxy.add(node.host, node.port,
+                                                   "%s/%s" % (config["project"], node.label))
+            except socket.error as err:
+                failures.append((node.label, "console proxy: %s" % err))
+                continue
+            node = node._replace(host=local_host, port=local_port)
+        if template:
+            jobs.append((node.label, template.render(node)))
+        else:
+            failures.append((node.label, "no %s client is set" % node.console_type))
+    return jobs, failures
+
+
+# Telnet commands (RFC 854) the proxy has to know about
+TELNET_IAC = 255
+TELNET_NEGOTIATION = (251, 252, 253, 254) # WILL, WONT, DO, DONT
+TELNET_SB = 250
+TELNET_SE = 240
+MAX_CLIENT_BUFFER = 1048576
+
+
+class TelnetScanner(object):
+    """
+    Splits a telnet byte stream into data and option negotiation commands
+    (WILL/WONT/DO/DONT and subnegotiations). A command cut in half by the
+    chunk boundary is kept until the next chunk arrives.
+    """
+
+    def __init__(self):
+        self._pending = bytearray()
+
+    def feed(self, data):
+        """
+        Returns the data without the negotiation commands and the list of
+        those commands.
+        """
+
+        buf = self._pending + bytearray(data)
+        out = bytearray()
+        commands = []
+        i = 0
+        while i < len(buf):
+            if buf[i] != TELNET_IAC:
+                out.append(buf[i])
+                i += 1
+                continue
+            if i + 1 >= len(buf):
+                break
+            command = buf[i + 1]
+            if command in TELNET_NEGOTIATION:
+                if i + 2 >= len(buf):
+                    break
+                commands.append(bytes(buf[i:i + 3]))
+                i += 3
+            elif command == TELNET_SB:
+                end = buf.find(bytearray([TELNET_IAC, TELNET_SE]), i + 2)
+                if end < 0:
+                    break
+                commands.append(bytes(buf[i:end + 2]))
+                i = end + 2
+            else:
+                out += buf[i:i + 2] # Other commands and escaped 255 bytes
+                i += 2
+        self._pending = buf[i:]
+        return bytes(out), commands
+
+
+class ProxiedConsole(object):
+    """
+    A node console behind the telnet proxy: the local listener, the single
+    upstream connection and the local clients sharing it.
+    """
+
+    def __init__(self, upstream_address, listener, name):
+        self.upstream_address = upstream_address
+        self.listener = listener
+        self.name = name
+        self.upstream = None
+        self.connecting = False
+        self.upstream_out = bytearray()
+        self.scanner = TelnetScanner()
+        self.negotiation = collections.OrderedDict() # (WILL/WONT?, option) -> the server's last command
+        self.clients = collections.OrderedDict() # Socket -> [output buffer, TelnetScanner]
+
+    def close_upstream(self):
+        if self.upstream:
+            self.upstream.close()
+        self.upstream = None
+        self.connecting = False
+        self.upstream_out = bytearray()
+        self.scanner = TelnetScanner()
+        self.negotiation.clear()
+
+
+class TelnetProxy(object):
+    """
+    Local telnet proxy that keeps a single upstream connection per node
+    console, however many local clients are connected to it.
+
+    Everything the node sends is copied to every client, and the input of
+    all clients is merged into the upstream connection. The server's option
+    negotiation is replayed to clients that join later; only the first
+    client's negotiation answers are forwarded to the server, the others'
+    are dropped so the server doesn't get them several times.
+
+    Everything runs in one background thread around a selector (epoll or
+    kqueue where available, so there's no limit on the descriptor numbers).
+    If a SessionRecorder is set as "recorder", the traffic of the consoles
+    is recorded too.
+    """
+
+    def __init__(self, listen_host="127.0.0.1", recorder=None):
+        self.listen_host = listen_host
+        self.recorder = recorder
+        self._consoles = {} # (host, port) upstream -> ProxiedConsole
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def add(self, gns3_host, gns3_port, name=None):
+        """
+        Makes a node console available through the proxy and returns the
+        local (host, port) to connect to. The same port number as upstream is
+        used if it's free, so the mapping is easy to follow. "name" is used
+        for the session logs.
+        """
+
+        key = (gns3_host, int(gns3_port))
+        with self._lock:
+            if key not in self._consoles:
+                listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                try:
+                    listener.bind((self.listen_host, key[1]))
+                except socket.error:
+                    listener.bind((self.listen_host, 0))
+                listener.listen(16)
+                listener.setblocking(0)
+                self._consoles[key] = ProxiedConsole(key, listener, name or "%s_%d" % key)
+            local_port = self._consoles[key].listener.getsockname()[1]
+        return self.listen_host, local_port
+
+    def client_count(self):
+        """
+        Returns the number of connected local clients.
+        """
+        with self._lock:
+            return sum(len(console.clients) for console in self._consoles.values())
+
+    def upstream_count(self):
+        """
+        Returns the number of open upstream connections.
+        """
+        with self._lock:
+            return len([console for console in self._consoles.values() if console.upstream])
+
+    def start(self):
+        """
+        Starts the proxy thread if it isn't running yet.
+        """
+        if not self._thread:
+            self._thread = threading.Thread(target=self._loop)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        """
+        Stops the proxy thread and closes every connection.
+        """
+        self._stopped.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        with self._lock:
+            for console in self._consoles.values():
+                for client in console.clients:
+                    client.close()
+                console.close_upstream()
+                console.listener.close()
+            self._consoles = {}
+
+    def _loop(self):
+        selector = selectors.DefaultSelector()
+        registered = {} # Socket -> (events, console) registered in the selector
+        try:
+            while not self._stopped.is_set():
+                wanted = {}
+                with self._lock:
+                    consoles = list(self._consoles.values())
+                for console in consoles:
+                    wanted[console.listener] = (selectors.EVENT_READ, console)
+                    if console.connecting:
+                        wanted[console.upstream] = (selectors.EVENT_WRITE, console)
+                    elif console.upstream:
+                        events = selectors.EVENT_READ
+                        if console.upstream_out:
+                            events |= selectors.EVENT_WRITE
+                        wanted[console.upstream] = (events, console)
+                    for client, (out, _) in console.clients.items():
+                        events = selectors.EVENT_READ
+                        if out:
+                            events |= selectors.EVENT_WRITE
+                        wanted[client] = (events, console)
+                self._update_selector(selector, registered, wanted)
+
+                for key, events in selector.select(0.2):
+                    self._handle(key.fileobj, key.data, events)
+        finally:
+            selector.close()
+
+    def _update_selector(self, selector, registered, wanted):
+        """
+        Brings the selector's registrations in line with "wanted". A socket
+        that can't be registered is reported and dropped, rather than
+        failing every round of the loop.
+        """
+
+        for sock in [sock for sock in registered if sock not in wanted]:
+            del registered[sock]
+            try:
+                selector.unregister(sock)
+            except (KeyError, ValueError, OSError):
+                pass # Closed already
+        for sock, (events, console) in wanted.items():
+            try:
+                if sock not in registered:
+                    selector.register(sock, events, console)
+                elif registered[sock][0] != events:
+                    selector.modify(sock, events, console)
+            except (KeyError, ValueError, OSError) as err:
+                print("Console proxy: %s: %s" % (console.name, err), file=sys.stderr)
+                self._drop_socket(console, sock, str(err))
+                continue
+            registered[sock] = (events, console)
+
+    def _drop_socket(self, console, sock, reason):
+        """
+        Closes a socket of a console that can't be served.
+        """
+
+        if sock is console.listener:
+            with self._lock:
+                self._consoles.pop(console.upstream_address, None)
+            self._drop_clients(console, reason)
+            console.listener.close()
+        elif sock is console.upstream:
+            self._drop_clients(console, reason)
+        elif sock in console.clients:
+            self._remove_client(console, sock)
+
+    def _handle(self, sock, console, events):
+        """
+        Serves a socket the selector found ready.
+        """
+
+        if sock is console.listener:
+            self._accept(console)
+        elif sock is console.upstream:
+            if events & selectors.EVENT_WRITE:
+                self._write_upstream(console)
+            if events & selectors.EVENT_READ and sock is console.upstream:
+                self._read_upstream(console)
+        elif sock in console.clients: # Not closed by an earlier event
+            if events & selectors.EVENT_READ:
+                self._read_client(console, sock)
+            if events & selectors.EVENT_WRITE and sock in console.clients:
+                self._write_client(console, sock)
+
+    def _accept(self, console):
+        try:
+            client, _ = console.listener.accept()
+        except socket.error:
+            return
+        client.setblocking(0)
+        console.clients[client] = [bytearray(b"".join(console.negotiation.values())),
+                                   TelnetScanner()]
+        if not console.upstream:
+            upstream = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            upstream.setblocking(0)
+            error = upstream.connect_ex(console.upstream_address)
+            if error not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK,
+                             getattr(errno, "WSAEWOULDBLOCK", -1)):
+                upstream.close()
+                self._drop_clients(console, os.strerror(error))
+                return
+            console.upstream = upstream
+            console.connecting = True
+
+    def _drop_clients(self, console, reason):
+        """
+        Closes the local clients after telling them what happened.
+        """
+
+        for client in console.clients:
+            try:
+                client.send(("\r\n[Console proxy: %s]\r\n" % reason).encode("ascii", "replace"))
+            except socket.error:
+                pass
+            client.close()
+        console.clients.clear()
+        console.close_upstream()
+
+    def _remove_client(self, console, client):
+        client.close()
+        del console.clients[client]
+        if not console.clients:
+            console.close_upstream()
+
+    def _write_upstream(self, console):
+        if console.connecting:
+            error = console.upstream.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if error:
+                self._drop_clients(console, os.strerror(error))
+                return
+            console.connecting = False
+        if console.upstream_out:
+            try:
+                sent = console.upstream.send(console.upstream_out)
+            except socket.error as err:
+                self._drop_clients(console, str(err))
+                return
+            del console.upstream_out[:sent]
+
+    def _read_upstream(self, console):
+        try:
+            data = console.upstream.recv(65536)
+        except socket.error as err:
+            self._drop_clients(console, str(err))
+            return
+        if not data:
+            self._drop_clients(console, "the node closed the console")
+            return
+        text, commands = console.scanner.feed(data)
+        for command in commands:
+            if len(command) == 3:
+                # WILL/WONT and DO/DONT of an option are separate states
+                console.negotiation[(command[1] in (251, 252), command[2])] = command
+        if self.recorder and text:
+            self.recorder.record(console.name, "out", text)
+        for client, (out, _) in list(console.clients.items()):
+            out += data
+            if len(out) > MAX_CLIENT_BUFFER: # The client doesn't keep up
+                self._remove_client(console, client)
+
+    def _read_client(self, console, client):
+        try:
+            data = client.recv(65536)
+        except socket.error:
+            data = b""
+        if not data:
+            self._remove_client(console, client)
+            return
+        text = console.clients[client][1].feed(data)[0]
+        if client is not next(iter(console.clients)):
+            data = text # Only the first client negotiates with the server
+        console.upstream_out += data
+        if self.recorder and text:
+            self.recorder.record(console.name, "in", text)
+
+    def _write_client(self, console, client):
+        out = console.clients[client][0]
+        try:
+            sent = client.send(out)
+        except socket.error:
+            self._remove_client(console, client)
+            return
+        del out[:sent]
+
+
+# Started on demand, it lives as long as the program, like the consoles using it
+TELNET_PROXY = None
+
+
+def get_telnet_proxy(listen_host):
+    """
+    Returns the running telnet proxy, starting it if needed.
+    """
+
+    global TELNET_PROXY
+    if TELNET_PROXY is None:
+        TELNET_PROXY = TelnetProxy(listen_host)
+        TELNET_PROXY.start()
+    return TELNET_PROXY
+
+
+class MappedLog(object):
+    """
+    Append-only log file written through a memory map. The file is grown in
+    "grow_size" steps and the map is remapped when it's full; closing the
+    log truncates the unused tail. If the program dies before that, the
+    zero bytes at the end are recognized and overwritten next time.
+    """
+
+    def __init__(self, path, grow_size=1048576):
+        self.path = path
+        self.grow_size = grow_size
+        self._file = open(path, "a+b")
+        self._file.seek(0, os.SEEK_END)
+        self.size = self._file.tell()
+        self._map = None
+        self._capacity = self.size
+        if self.size:
+            self._map = mmap.mmap(self._file.fileno(), self.size)
+            while self.size and self._map[self.size - 1:self.size] == b"\0":
+                self.size -= 1
+
+    def _grow(self, needed):
+        if self._map:
+            self._map.flush()
+            self._map.close()
+        self._capacity = max(self._capacity + self.grow_size, self.size + needed)
+        self._file.truncate(self._capacity)
+        self._map = mmap.mmap(self._file.fileno(), self._capacity)
+
+    def append(self, data):
+        """
+        Appends the bytes to the end of the log.
+        """
+
+        if self.size + len(data) > self._capacity:
+            self._grow(len(data))
+        self._map[self.size:self.size + len(data)] = data
+        self.size += len(data)
+
+    def close(self):
+        """
+        Writes everything to the disk and cuts the unused tail.
+        """
+
+        if self._map:
+            self._map.flush()
+            self._map.close()
+            self._map = None
+        self._file.truncate(self.size)
+        self._file.close()
+
+
+class SessionRecorder(object):
+    """
+    Records the console traffic going through the telnet proxy.
+
+    record() only appends to in-memory buffers, so it doesn't slow down the
+    interactive session: every console has a ring buffer of the last
+    "scrollback" bytes of output for live viewing, and a background thread
+    flushes the pending data every "flush_interval" seconds to the
+    append-only, memory-mapped logs in "log_dir":
+        <project>/<node>.out.log - What the node sent
+        <project>/<node>.in.log - What the users typed
+    Every flushed batch starts with a timestamp line.
+    """
+
+    def __init__(self, log_dir, scrollback=65536, flush_interval=1.0):
+        self.log_dir = log_dir
+        self.scrollback_size = scrollback
+        self.flush_interval = flush_interval
+        self._scrollback = {} # Console name -> deque of output chunks
+        self._scrollback_bytes = {}
+        self._pending = []
+        self._logs = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def record(self, console_name, direction, data):
+        """
+        Records a chunk of traffic; "direction" is "out" for what the node
+        sent and "in" for what a user typed.
+        """
+
+        with self._lock:
+            self._pending.append((console_name, direction, bytes(data)))
+            if direction == "out":
+                chunks = self._scrollback.setdefault(console_name, collections.deque())
+                chunks.append(bytes(data))
+                total = self._scrollback_bytes.get(console_name, 0) + len(data)
+                while total > self.scrollback_size and len(chunks) > 1:
+                    total -= len(chunks.popleft())
+                self._scrollback_bytes[console_name] = total
+
+    def scrollback(self, console_name):
+        """
+        Returns the latest output of the console, at most "scrollback" bytes
+        (plus the rest of the oldest chunk).
+        """
+
+        with self._lock:
+            return b"".join(self._scrollback.get(console_name, ()))
+
+    def log_path(self, console_name, direction):
+        """
+        Returns the path of a console's log file.
+        """
+
+        project, _, node = console_name.rpartition("/")
+        return os.path.join(self.log_dir, safe_file_name(project or "default"),
+                            "%s.%s.log" % (safe_file_name(node), direction))
+
+    def flush(self):
+        """
+        Writes the pending data to the log files.
+        """
+
+        with self._lock:
+            pending, self._pending = self._pending, []
+        if not pending:
+            return
+        batches = collections.OrderedDict()
+        for console_name, direction, data in pending:
+            batches.setdefault((console_name, direction), []).append(data)
+        stamp = time.strftime("\n=== %Y-%m-%d %H:%M:%S ===\n").encode("ascii")
+        for key, chunks in batches.items():
+            if key not in self._logs:
+                path = self.log_path(*key)
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                self._logs[key] = MappedLog(path)
+            self._logs[key].append(stamp + b"".join(chunks))
+
+    def close(self):
+        """
+        Flushes the pending data and closes the logs.
+        """
+
+        self._stopped.set()
+        self._thread.join()
+        self.flush()
+        for log in self._logs.values():
+            log.close()
+        self._logs = {}
+
+    def _run(self):
+        while not self._stopped.wait(self.flush_interval):
+            try:
+                self.flush()
+            except (IOError, OSError) as err:
+                print("\nError when writing the session logs:", err)
+
+
+def safe_file_name(name):
+    """
+    Replaces the characters that aren't safe in file names.
+    """
+    return re.sub(r"[^\w.-]", "_", name)
+
+
+def search_logs(log_dir, pattern):
+    """
+    Searches the session logs for a regular expression (given as a
+    string) and yields (path, line) pairs of the matching lines. The files
+    are memory-mapped, so they're never loaded into memory as a whole.
+    Raises ValueError if the pattern isn't a valid regular expression.
+    """
+
+    try:
+        regex = re.compile(pattern.encode("utf-8"))
+    except re.error as err:
+        raise ValueError("Invalid pattern %r: %s" % (pattern, err))
+    for root, _, files in os.walk(log_dir):
+        for file_name in sorted(files):
+            path = os.path.join(root, file_name)
+            if not file_name.endswith(".log") or not os.path.getsize(path):
+                continue
+            with open(path, "rb") as log_file:
+                log_map = mmap.mmap(log_file.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    line_end = -1
+                    for match in regex.finditer(log_map):
+                        if match.start() <= line_end:
+                            continue # One line is reported only once
+                        line_start = log_map.rfind(b"\n", 0, match.start()) + 1
+                        line_end = log_map.find(b"\n", match.end())
+                        if line_end < 0:
+                            line_end = len(log_map)
+                        yield path, log_map[line_start:line_end].rstrip(b"\r\0")
+                finally:
+                    log_map.close()
+
+
+# Started on demand, like TELNET_PROXY
+SESSION_RECORDER = None
+
+
+def get_session_recorder(log_dir):
+    """
+    Returns the session recorder, starting it if needed.
+    """
+
+    global SESSION_RECORDER
+    if SESSION_RECORDER is None:
+        SESSION_RECORDER = SessionRecorder(log_dir)
+        atexit.register(SESSION_RECORDER.close)
+    return SESSION_RECORDER
+
+
+def console_proxy(config):
+    """
+    Returns the telnet proxy if the config asks for it, otherwise None.
+    """
+
+    proxy = None
+    if config["console"].get("telnet_proxy") or config["console"].get("record_sessions"):
+        proxy = get_telnet_proxy(config["console"].get("telnet_proxy_listen", "127.0.0.1"))
+    if config["console"].get("record_sessions"):
+        # Recording needs the traffic to go through the proxy
+        proxy.recorder = get_session_recorder(config["console"].get("session_log_dir", "session_logs"))
+    return proxy
+
+
+def wait_for_proxy_clients(grace=0):
+    """
+    Keeps the program (and so the telnet proxy) running while consoles are
+    connected through the proxy, because exiting would cut them off. Waits
+    "grace" seconds for the first console to connect.
+    """
+
+    if not TELNET_PROXY:
+        return
+    deadline = time.time() + grace
+    while not TELNET_PROXY.client_count() and time.time() < deadline:
+        sleep(0.1)
+    if TELNET_PROXY.client_count():
+        print("Consoles are still open through the console proxy, it keeps running until\n"
+              "they're closed. Press Ctrl-C to stop it.")
+        try:
+            while TELNET_PROXY.client_count():
+                sleep(1)
+        except KeyboardInterrupt:
+            pass
+
+
+def console_key(config, servers, node):
+    """
+    Returns the key of a node's console in CONSOLES: the node's server,
+    project and name.
+    """
+    return (node.server or server_label(servers[0]), config["project"], node.name)
+
+
+def console_marks(config, servers, nodes):
+    """
+    Returns the labels of the nodes whose console is open, and of the
+    nodes whose console was opened in this session, as two sets.
+    """
+
+    opened = set()
+    launched = set()
+    if len(CONSOLES):
+        for node in nodes:
+            key = console_key(config, servers, node)
+            if CONSOLES.launched(key):
+                launched.add(node.label)
+                if CONSOLES.is_open(key):
+                    opened.add(node.label)
+    return opened, launched
+
+
+def open_consoles(config, servers, nodes, launcher, proxy):
+    """
+    Opens the consoles of the nodes and registers them in CONSOLES.
+    Returns the (name, error) pairs of the ones that couldn't be opened.
+    """
+
+    keys = dict((node.label, console_key(config, servers, node)) for node in nodes)
+    jobs, failures = console_jobs(config, nodes, proxy)
+    return failures + run_core(launcher.launch(jobs, keys))
+
+
+def report_launch_failures(failures):
+    """
+    Tells the user which consoles couldn't be opened.
+    """
+
+    if failures:
+        print("\nError: %d console(s) couldn't be opened:" % len(failures))
+        for name, error in failures:
+            print("  %s: %s" % (name, error))
+        input("Press Enter to continue.")
+
+
+# ANSI escape sequences of the menus
+ANSI_HOME = "\x1b[H"
+ANSI_CLEAR_SCREEN = "\x1b[2J"
+ANSI_CLEAR_LINE = "\x1b[K" # From the cursor to the end of the line
+ANSI_CLEAR_BELOW = "\x1b[J" # From the cursor to the end of the screen
+
+
+def enable_ansi():
+    """
+    Returns whether the terminal understands ANSI escape sequences. The
+    Windows console (Windows 10 or later) has to be switched to that mode.
+    """
+
+    if not sys.platform.startswith("win"):
+        return os.environ.get("TERM") != "dumb"
+    try:
+        import ctypes
+        kernel32 = ctypes.windll.kernel32
+        handle = kernel32.GetStdHandle(-11) # STD_OUTPUT_HANDLE
+        mode = ctypes.c_uint32()
+        if not kernel32.GetConsoleMode(handle, ctypes.byref(mode)):
+            return False
+        # ENABLE_VIRTUAL_TERMINAL_PROCESSING
+        return bool(kernel32.SetConsoleMode(handle, mode.value | 0x0004))
+    except (ImportError, AttributeError, OSError):
+        return False
+
+
+class Terminal(object):
+    """
+    Draws the menus. Every screen is built in memory and written at once:
+    on a terminal the cursor is moved home and the previous screen is
+    overwritten line by line with ANSI escape sequences, so there's no
+    "clear" process to start and nothing flickers. Consoles without ANSI
+    support are still cleared with cls, and if the output isn't a terminal
+    (e.g. a pipe) the screens are written one after the other.
+    """
+
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stdout
+        self._ansi = None
+
+    def is_terminal(self):
+        """
+        Returns whether the output is a terminal.
+        """
+        return self.stream.isatty()
+
+    def ansi(self):
+        """
+        Returns whether ANSI escape sequences are used.
+        """
+        if self._ansi is None:
+            self._ansi = self.is_terminal() and enable_ansi()
+        return self._ansi
+
+    def size(self):
+        """
+        Returns the (columns, lines) of the terminal.
+        """
+        return shutil.get_terminal_size((80, 24))
+
+    def draw(self, text):
+        """
+        Replaces the screen with the text in one write. The cursor stays at
+        the end of the text, so the last line can be a prompt.
+        """
+
+        with TIMINGS.timed("render"):
+            if self.ansi():
+                lines = text.split("\n")
+                if len(lines) >= self.size()[1]:
+                    # It scrolls anyway, so the old screen has to go at once
+                    text = ANSI_HOME + ANSI_CLEAR_SCREEN + text
+                else:
+                    text = ANSI_HOME + (ANSI_CLEAR_LINE + "\n").join(lines) \
+                           + ANSI_CLEAR_LINE + ANSI_CLEAR_BELOW
+            elif self.is_terminal():
+                os.system("cls" if os.name == "nt" else "clear")
+            self.stream.write(text)
+            self.stream.flush()
+
+
+TERMINAL = Terminal()
+
+
+# Escape sequences (POSIX) and scan codes (Windows) of the keys the node menu uses
+KEY_SEQUENCES = {"\x1b[A": "up", "\x1b[B": "down", "\x1bOA": "up", "\x1bOB": "down",
+                 "\x1b[5~": "page_up", "\x1b[6~": "page_down"}
+WINDOWS_KEYS = {"H": "up", "P": "down", "I": "page_up", "Q": "page_down"}
+
+
+class KeyReader(object):
+    """
+    Reads single key presses for the node menu. Printable characters are
+    returned as they are, the other keys by name: enter, backspace, escape,
+    up, down, page_up, page_down. On POSIX the terminal is only in cbreak
+    mode while a key is awaited, so input() works as usual in between.
+    """
+
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stdin
+
+    @staticmethod
+    def available(stream=None):
+        """
+        Returns whether single keys can be read (the input is a terminal).
+        """
+        stream = stream or sys.stdin
+        return stream.isatty() and (termios is not None or msvcrt is not None)
+
+    def read(self, timeout):
+        """
+        Waits at most "timeout" seconds for a key press. Returns None if
+        there wasn't any, or it was a key the menu doesn't use.
+        """
+
+        if termios is None:
+            return self._read_windows(timeout)
+        fd = self.stream.fileno()
+        saved = termios.tcgetattr(fd)
+        try:
+            tty.setcbreak(fd, termios.TCSANOW)
+            if not select.select([fd], [], [], timeout)[0]:
+                return None
+            key = os.read(fd, 1)
+            if key == b"\x1b":
+                # An escape sequence arrives at once, a lone Esc doesn't continue
+                while len(key) < 4 and select.select([fd], [], [], 0.05)[0]:
+                    key += os.read(fd, 1)
+                    if key[-1:].isalpha() or key.endswith(b"~"):
+                        break
+                if len(key) > 1:
+                    return KEY_SEQUENCES.get(key.decode("ascii", "replace"))
+            elif key[0] >= 0x80:
+                # The rest of a multibyte UTF-8 character
+                decoder = codecs.getincrementaldecoder("utf-8")("replace")
+                text = decoder.decode(key)
+                while not text and select.select([fd], [], [], 0.05)[0]:
+                    text = decoder.decode(os.read(fd, 1))
+                return self._name(text or decoder.decode(b"", True))
+            return self._name(key.decode("ascii"))
+        finally:
+            termios.tcsetattr(fd, termios.TCSANOW, saved)
+
+    def _read_windows(self, timeout):
+        deadline = time.time() + timeout
+        while not msvcrt.kbhit():
+            if time.time() >= deadline:
+                return None
+            sleep(0.02)
+        key = msvcrt.getwch()
+        if key in ("\x00", "\xe0"):
+            return WINDOWS_KEYS.get(msvcrt.getwch())
+        if key == "\x03":
+            raise KeyboardInterrupt
+        return self._name(key)
+
+    @staticmethod
+    def _name(key):
+        if key in ("\r", "\n"):
+            return "enter"
+        if key in ("\x7f", "\x08"):
+            return "backspace"
+        if key == "\x1b":
+            return "escape"
+        if key.isprintable():
+            return key
+        return None
+
+
+class NodeMenu(object):
+    """
+    What the node menu shows of a node snapshot: the nodes matching the
+    filter (a query of the snapshot's NodeIndex: parts of names, patterns,
+    ~fuzzy and type:/host:/console: groups), a page at a time. The nodes
+    keep their numbers (positions in the whole snapshot) while filtering
+    and paging, and neither fetches anything again.
+
+    In key mode (see KeyReader) the filter follows the typing: text filters
+    at once, a number typed and Enter chooses that option, Enter on a text
+    keeps it as the filter (or chooses the node if only one matches), Esc
+    clears it. In line mode, "/text" sets the filter and "n" / "p" page.
+    """
+
+    def __init__(self):
+        self.filter = ""
+        self.page = 0
+        self.typed = "" # Key mode: what was typed since the last Enter
+
+    def matches(self, nodes):
+        """
+        Returns the (number, node) pairs of the nodes matching the filter.
+        """
+        return [(position + 1, nodes[position]) for position in nodes.index().search(self.filter)]
+
+    def page_of(self, entries, page_size):
+        """
+        Returns the entries of the current page and the number of pages.
+        Without a page size, everything is on one page.
+        """
+        if not page_size:
+            self.page = 0
+            return entries, 1
+        pages = max(1, (len(entries) + page_size - 1) // page_size)
+        self.page = min(max(self.page, 0), pages - 1)
+        return entries[self.page * page_size:(self.page + 1) * page_size], pages
+
+    def command(self, text):
+        """
+        Line mode: handles the filter and paging commands. Returns None if
+        the text was one of those, otherwise the text as the user's choice.
+        """
+        if text.startswith("/"):
+            self.filter = text[1:].strip()
+            self.page = 0
+            return None
+        if text.lower() in ("n", "p"):
+            self.page += 1 if text.lower() == "n" else -1
+            return None
+        return text
+
+    def key(self, key, nodes):
+        """
+        Key mode: handles a key press. Returns the user's choice when it's
+        complete (Enter), otherwise None.
+        """
+        if key == "enter":
+            typed, self.typed = self.typed, ""
+            if typed.isdigit() or not typed:
+                return typed
+            matches = self.matches(nodes)
+            if len(matches) == 1:
+                return str(matches[0][0])
+            return None # The text stays as the filter
+        if key in ("up", "page_up", "down", "page_down"):
+            self.page += 1 if key in ("down", "page_down") else -1
+            return None
+        if key == "escape":
+            self.typed = ""
+        elif key == "backspace":
+            self.typed = self.typed[:-1]
+        else:
+            self.typed += key
+        if not self.typed.isdigit():
+            self.filter = self.typed
+            self.page = 0
+        return None
+
+
+def node_groups(index, width, most=3):
+    """
+    Returns a hint of the biggest node groups of a NodeIndex that fits in
+    "width" characters, like "type:dynamips (240), host:10.0.0.1 (200)".
+    """
+
+    groups = []
+    for key in ("type", "host", "console"):
+        summary = index.summary(key)
+        if len(summary) > 1:
+            groups.append(["%s:%s (%d)" % (key, value, count) for value, count in summary[:most]])
+    hint = []
+    for rank in range(most): # The biggest group of every key first
+        for key_groups in groups:
+            if rank < len(key_groups) and len(", ".join(hint + [key_groups[rank]])) <= width:
+                hint.append(key_groups[rank])
+    return ", ".join(hint) or "-"
+
+
+def node_menu_screen(menu, nodes, servers, error, changes, reachability, height, key_mode,
+                     saved=None, marks=(frozenset(), frozenset())):
+    """
+    Builds the node menu's screen as a single text, fitting the page of
+    nodes to the terminal's height (None: no paging). "changes" is the
+    (added, removed, changed) result of diff_nodes; "saved" is the time
+    the nodes were saved if they're the saved ones (see SnapshotFile);
+    "marks" is the result of console_marks.
+    """
+
+    added, removed, changed = changes
+    header = ["Remote Console for GNS3", "=======================", ""]
+    for server in servers:
+        latency = API_CLIENT.last_latency(server["ip"], server["port"])
+        if latency is not None:
+            header.append("Server: %s (last request: %.0f ms)" % (server_label(server), latency))
+    header.append("")
+    if saved:
+        saved = time.strftime("%Y-%m-%d %H:%M", time.localtime(saved))
+    if error and saved:
+        header += ["Warning: %s. Showing the nodes saved on %s." % (error.reason, saved), ""]
+    elif error:
+        header += ["Warning: %s. Showing the last known nodes." % error.reason, ""]
+    elif saved:
+        header += ["Showing the nodes saved on %s, refreshing..." % saved, ""]
+    if added or removed or changed:
+        header += ["Since last refresh: %d added (+), %d changed (*), %d removed%s" \
+                   % (len(added), len(changed), len(removed), \
+                      " [%s]" % ", ".join(removed) if removed else ""), ""]
+    header.append("Choose an option:")
+
+    entries = menu.matches(nodes)
+    count = len(nodes)
+    opened, launched = marks
+    open_count = sum(1 for _, node in entries if node.label in opened)
+    launched_count = sum(1 for _, node in entries if node.label in launched)
+    open_all = "Open all consoles"
+    close = "Close the open consoles (%d)" % open_count
+    reopen = "Reopen the consoles opened before (%d)" % launched_count
+    if menu.filter:
+        header.append('Filter "%s": %d of %d nodes' % (menu.filter, len(entries), count))
+        open_all = "Open the matching consoles (%d)" % len(entries)
+        close = "Close the matching open consoles (%d)" % open_count
+        reopen = "Reopen the matching consoles opened before (%d)" % launched_count
+    if key_mode:
+        prompt = "Choice or filter (Enter to refresh, Esc to clear, PgUp/PgDn to scroll): " + menu.typed
+    else:
+        prompt = "Enter your choice (Enter to refresh, /name to filter, n/p for pages): "
+    footer = ["%d) %s" % (count + 1, open_all), "%d) %s" % (count + 2, close),
+              "%d) %s" % (count + 3, reopen), "%d) Return to main menu" % (count + 4),
+              "%d) Exit" % (count + 5), "", prompt]
+
+    page_size = None
+    if height:
+        if not menu.filter and len(entries) > height - len(header) - len(footer) - 1:
+            # Big project: a hint of the groups to filter by
+            header.append("Groups: " + node_groups(nodes.index(), 71))
+        page_size = max(3, height - len(header) - len(footer) - 1)
+        if len(entries) > page_size:
+            page_size -= 1 # The line of the page number
+    shown, pages = menu.page_of(entries, page_size)
+    lines = header
+    if pages > 1:
+        lines.append("Page %d of %d (%s)" % (menu.page + 1, pages,
+                                            "PgUp/PgDn" if key_mode else "n/p"))
+    for number, node in shown:
+        if node.label in added:
+            marker = " (+)"
+        elif node.label in changed:
+            marker = " (*)"
+        else:
+            marker = ""
+        state = console_state(node, reachability)
+        if state:
+            marker += " [%s]" % state
+        if node.label in opened:
+            marker += " [open]"
+        lines.append("%d) %s%s" % (number, node.label, marker))
+    if not entries:
+        lines.append("   (no matching nodes)")
+    return "\n".join(lines + footer)
 
 
 def console_connect():
     """
     This function does the primary job: initiating telnet/vnc sessions
-    to the selected nodes.
+    to the selected nodes. Returns True if the user chose to exit.
     """
 
+    started = time.time()
     config = load_config()
-    config_ip = config["server"]["ip"]
-    config_port = config["server"]["port"]
-    config_project_name = config["project"]
-    config_console_telnet = config["console"]["telnet_selected"]
-    config_console_vnc = config["console"]["vnc_selected"]
-
+    servers = configured_servers(config)
+    launcher = ConsoleLauncher(int(config["console"].get("max_parallel_launches",
+                                                         DEFAULT_PARALLEL_LAUNCHES)))
+    probe_timeout = float(config["console"].get("probe_timeout", DEFAULT_PROBE_TIMEOUT))
+    proxy = console_proxy(config)
+
+    # With single key presses the menu is redrawn as soon as the snapshot
+    # changes, otherwise the user is told to press Enter.
+    keys = KeyReader() if KeyReader.available() and TERMINAL.ansi() else None
+    on_change = None
+    if not keys:
+        on_change = lambda: print("\n[The node list has changed. Press Enter to refresh.]")
+
+    # The node list is refreshed in the background; the menu is always drawn
+    # from the latest snapshot. Until the first refresh, it's the one saved
+    # last time.
+    use_snapshot = config["server"].get("snapshot", True)
+    initial, saved = saved_nodes(servers) if use_snapshot else (None, None)
+    poller = NodePoller(servers,
+                        interval=float(config["server"].get("poll_interval", DEFAULT_POLL_INTERVAL)),
+                        stream=config["server"].get("stream_nodes", False),
+                        on_change=on_change, probe_timeout=probe_timeout, initial=initial)
+    poller.start()
+
+    menu = NodeMenu()
+    parsed_nodes = None
+    saved_snapshot = None # The snapshot last written to the disk
+    changes = (set(), [], set())
+    shown_reachability = None
+    shown_status = None
+    redraw = True
     node_menu = True
-    while node_menu:
-        # Get a list of nodes of the selected project
-        projects = get_project(config_ip, config_port)
-        project_id = find_project_id(projects, config_project_name)
-        nodes_list = get_nodes(config_ip, config_port, project_id)
-        parsed_nodes = parse_nodes(nodes_list)
-
-        # Print nodes, asks for user input
-        if parsed_nodes:
-            os.system("cls" if os.name == "nt" else "clear")
-            print (
-                """Remote Console for GNS3\n"""
-                """=======================\n\n"""
-                """Choose an option:""")
-            i = 1
-            for parsed_node in parsed_nodes:
-                print("%d) %s" % (i, parsed_node[0]))
-                i += 1
-            print("%d) Open all consoles" % i)
-            i += 1
-            print("%d) Return to main menu" % i)
-            i += 1
-            print("%d) Exit\n" % i)
-            node_choice = raw_input("Enter your choice: ")
+    try:
+        while node_menu:
+            nodes, error = poller.wait()
+            if nodes is None:
+                if error.status == 404:
+                    input("Error: Unknown project. Press Enter to continue.")
+                    return
+                print("Error when connecting to GNS3 server:", error.reason)
+                input("Press Enter to return to the main menu.")
+                return
+            if not nodes:
+                input("Error: There are no applicable nodes in the project! Press Enter to continue.")
+                return
+
+            # Marking the nodes that changed since the previous snapshot. The
+            # poller keeps the same snapshot object while nothing changes.
+            if nodes is not parsed_nodes:
+                if parsed_nodes:
+                    added, removed, changed = diff_nodes(parsed_nodes, nodes)
+                    changes = (set(added), removed, set(changed))
+                parsed_nodes = nodes
+                redraw = True
+            if use_snapshot and not poller.stale and nodes is not saved_snapshot:
+                save_nodes(servers, poller.server_nodes())
+                saved_snapshot = nodes
+            if (error and error.reason, poller.stale) != shown_status:
+                shown_status = (error and error.reason, poller.stale)
+                redraw = True
+            if poller.reachability is not shown_reachability:
+                shown_reachability = poller.reachability
+                redraw = True
+            if CONSOLES.reap(): # Consoles closed by the user
+                redraw = True
+
+            count = len(parsed_nodes)
+            if redraw:
+                height = TERMINAL.size()[1] if TERMINAL.is_terminal() else None
+                TERMINAL.draw(node_menu_screen(menu, parsed_nodes, servers, error, changes,
+                                               shown_reachability, height, keys is not None,
+                                               saved if poller.stale else None,
+                                               console_marks(config, servers, parsed_nodes)))
+                redraw = False
+                if started:
+                    TIMINGS.observe("menu_ready", time.time() - started)
+                    started = None
+
+            if keys:
+                key = keys.read(0.2)
+                if key is None:
+                    continue # Checking for a new snapshot
+                redraw = True
+                node_choice = menu.key(key, parsed_nodes)
+                if node_choice is not None:
+                    print() # Leaving the prompt's line
+            else:
+                redraw = True
+                node_choice = menu.command(input())
+            if node_choice is None: # Filtering or paging
+                continue
+            if not node_choice:
+                poller.refresh_now()
+                continue
 
             # The try below checks input value; if it's not a number then sets the value
             # so high that it will always be out of range
@@ -179,52 +1740,42 @@ def console_connect():
                 node_choice = int(node_choice)
             except ValueError as err:
                 node_choice = 9999
-                raw_input("Error: %s\nPress Enter to try again." % err)
+                input("Error: %s\nPress Enter to try again." % err)
             else:
-                if node_choice > i: # Higher number was entered than the available options
-                    raw_input("Wrong selection. Press Enter to try again.")
-                elif node_choice == i: # Last option is always exiting
-                    quit()
-                elif node_choice == i-1: # Going back to the main menu
+                if node_choice > count + 5 or node_choice < 1: # Not one of the available options
+                    input("Wrong selection. Press Enter to try again.")
+                elif node_choice == count + 5: # Last option is always exiting
+                    return True
+                elif node_choice == count + 4: # Going back to the main menu
                     node_menu = False
-                elif node_choice == i-2: # Opening all nodes
-                    for node in parsed_nodes:
-                        if node[3] == "telnet":
-                            if config_console_telnet == "Custom":
-                                console_cmd = config["console"]["telnet_custom"].replace("%d", node[0])
-                                console_cmd = console_cmd.replace("%h", node[1])
-                                console_cmd = console_cmd.replace("%p", str(node[2]))
-                            else:
-                                # The following command selects the telnet command from the
-                                # predefined list, then replaces the %s variables with the
-                                # name, ip, and port values. Then the command is executed.
-                                console_cmd = TELNET_CMD[config_console_telnet].replace("%d", node[0])
-                                console_cmd = console_cmd.replace("%h", node[1])
-                                console_cmd = console_cmd.replace("%p", str(node[2]))
-                        elif node[3] == "vnc":
-                            if config_console_vnc == "Custom":
-                                console_cmd = config["console"]["vnc_custom"].replace("%h", node[1])
-                                console_cmd = console_cmd.replace("%p", str(node[2]))
-                            else:
-                                console_cmd = VNC_CMD[config_console_vnc].replace("%h", node[1])
-                                console_cmd = console_cmd.replace("%p", str(node[2]))
-                        os.system(console_cmd)
-                        sleep(0.333)
+                elif node_choice > count: # Bulk actions on the nodes matching the filter
+                    CONSOLES.reap()
+                    matching = [node for _, node in menu.matches(parsed_nodes)]
+                    matching_keys = [console_key(config, servers, node) for node in matching]
+                    if node_choice == count + 2: # Closing the open consoles
+                        CONSOLES.close(matching_keys)
+                        continue
+                    if node_choice == count + 3: # Reopening the consoles opened before
+                        CONSOLES.close(matching_keys)
+                        matching = [node for node, key in zip(matching, matching_keys) \
+                                    if CONSOLES.launched(key)]
+                    else: # Opening the consoles that are up and not open yet
+                        matching = [node for node, key in zip(matching, matching_keys) \
+                                    if not CONSOLES.is_open(key)]
+                    alive, skipped = live_nodes(matching, probe_timeout)
+                    report_launch_failures(skipped + open_consoles(config, servers, alive,
+                                                                   launcher, proxy))
                 else: # Opening the selected node
-                    selected_node = node_choice-1 # List count starts from zero; our list from 1
-
-                    # Checks if the node required telnet or VNCm then, as above, replaces the
-                    # %d/%h/%p variables witn the name, ip, and port values.
-                    # Then the command is executed.
-                    if parsed_nodes[selected_node][3] == "telnet":
-                        console_cmd = TELNET_CMD[config_console_telnet].replace("%d", parsed_nodes[selected_node][0])
-                        console_cmd = console_cmd.replace("%h", parsed_nodes[selected_node][1])
-                        console_cmd = console_cmd.replace("%p", str(parsed_nodes[selected_node][2]))
-                        os.system(console_cmd)
-                    elif parsed_nodes[selected_node][3] == "vnc":
-                        console_cmd = VNC_CMD[config_console_vnc].replace("%h", parsed_nodes[selected_node][1])
-                        console_cmd = console_cmd.replace("%p", str(parsed_nodes[selected_node][2]))
-                        os.system(console_cmd)
+                    # List count starts from zero; our list from 1
+                    node = parsed_nodes[node_choice-1]
+                    CONSOLES.reap()
+                    if CONSOLES.is_open(console_key(config, servers, node)):
+                        input("The console of %s is already open. Press Enter to continue." % node.label)
+                    else:
+                        report_launch_failures(open_consoles(config, servers, [node],
+                                                             launcher, proxy))
+    finally:
+        poller.stop()
     return
 
 
@@ -233,25 +1784,22 @@ def switch_project(gns3_ip, gns3_port):
     If the group leader loads a new project, users can switch here.
     """
 
-    i = 0
     menu_projects = True
     projects = get_project(gns3_ip, gns3_port) # Retrieves all projects
+    if projects is None:
+        return
 
     while menu_projects:
-        os.system("cls" if os.name == "nt" else "clear")
-        print (
+        TERMINAL.draw(
             """Remote Console for GNS3\n"""
             """=======================\n\n"""
-            """Available projects:""")
-        for project in projects:
-            # Printing the projects' names
-            i += 1
-            print("%d) %s" % (i, project["name"]))
-        project_choice = raw_input("\nEnter your choice: ")
+            """Available projects:\n""" \
+            + "".join("%d) %s\n" % (i, project["name"]) for i, project in enumerate(projects, 1)))
+        project_choice = input("\nEnter your choice: ")
         try:
             project_choice = int(project_choice)
         except ValueError as err:
-            raw_input("Error: %s \nPress Enter to continue." % err)
+            input("Error: %s \nPress Enter to continue." % err)
         else:
             # Replacing the project name in the config file
             config = load_config()
@@ -268,12 +1816,11 @@ def set_server(old_ip, old_port):
     server_menu = True
     while server_menu:
         # Asking for user input
-        os.system("cls" if os.name == "nt" else "clear")
-        print (
+        TERMINAL.draw(
             """Remote Console for GNS3\n"""
-            """=======================\n\n""")
-        new_ip = raw_input("Enter the GNS3 server IP [%s]: " % old_ip)
-        new_port = raw_input("Enter the GNS3 server IP [%s]: " % old_port)
+            """=======================\n\n\n""")
+        new_ip = input("Enter the GNS3 server IP [%s]: " % old_ip)
+        new_port = input("Enter the GNS3 server IP [%s]: " % old_port)
 
         # Input checking, if nothing is entered, the old values will be used
         if not new_ip:
@@ -282,13 +1829,11 @@ def set_server(old_ip, old_port):
             new_port = old_port
 
         # Validation by making an API call
-        url = "http://%s:%s/v2/projects" % (new_ip, new_port)
-
         try:
-            response = urllib2.urlopen(url)
-        except urllib2.URLError as err:
+            run_core(API_CLIENT.request(new_ip, new_port, "/v2/projects"))
+        except GNS3APIError as err:
             err_message = "Error when connecting to GNS3 server: %s)" % err.reason
-            raw_input("%s\nPress Enter to try again." % err_message)
+            input("%s\nPress Enter to try again." % err_message)
         else:
             # Replacing the server settings in the config file
             config = load_config()
@@ -311,13 +1856,11 @@ def set_telnet():
 
     while telnet_menu:
         telnet_menu = False
-        os.system("cls" if os.name == "nt" else "clear")
-        print(
-            """Remote Console for GNS3\n"""
-            """=======================\n\n"""
-            """Choose an option:\n""")
+        header = """Remote Console for GNS3\n""" \
+                 """=======================\n\n""" \
+                 """Choose an option:\n\n"""
         if sys.platform.startswith("win"):
-            print(
+            TERMINAL.draw(header +
                 """1) Putty\n"""
                 """2) MobaXterm\n"""
                 """3) Royal TS\n"""
@@ -330,9 +1873,9 @@ def set_telnet():
                 """10) Xshell 5\n"""
                 """11) ZOC 6\n"""
                 """12) Custom [%s]\n"""
-                """13) Return to main menu\n""" % config_custom_cmd)
+                """13) Return to main menu\n\n""" % config_custom_cmd)
 
-            telnet_choice = raw_input("Enter your choice [%s]: " % config_console_telnet)
+            telnet_choice = input("Enter your choice [%s]: " % config_console_telnet)
 
             if not telnet_choice:
                 telnet_choice = "13"
@@ -360,18 +1903,18 @@ def set_telnet():
             elif telnet_choice == "11":
                 telnet_new = "ZOC 6"
             elif telnet_choice == "12":
-                telnet_custom_new = raw_input("Enter the custom command: ")
+                telnet_custom_new = input("Enter the custom command: ")
                 telnet_new = "Custom"
             elif telnet_choice == "13":
                 telnet_menu = False
             else:
                 telnet_menu = True
-                raw_input("Error: Wrong selection. Press Enter to continue.")
+                input("Error: Wrong selection. Press Enter to continue.")
             # I know this was awful but python dictionaries are
             # unordered and this is a static list.
 
         else:
-            print(
+            TERMINAL.draw(header +
                 """1) Xterm\n"""
                 """2) Putty\n"""
                 """3) Gnome Terminal\n"""
@@ -382,8 +1925,8 @@ def set_telnet():
                 """8) Mate Terminal\n"""
                 """9) urxvt\n"""
                 """10) Custom [%s]\n"""
-                """11) Return to main menu\n""" % config_custom_cmd)
-            telnet_choice = raw_input("Enter your choice [%s]: " % config_console_telnet)
+                """11) Return to main menu\n\n""" % config_custom_cmd)
+            telnet_choice = input("Enter your choice [%s]: " % config_console_telnet)
 
             if not telnet_choice:
                 telnet_choice = "11"
@@ -407,13 +1950,13 @@ def set_telnet():
             elif telnet_choice == "9":
                 telnet_new = "urxvt"
             elif telnet_choice == "10":
-                telnet_custom_new = raw_input("Enter the custom command: ")
+                telnet_custom_new = input("Enter the custom command: ")
                 telnet_new = "Custom"
             elif telnet_choice == "11":
                 telnet_menu = False
             else:
                 telnet_menu = True
-                raw_input("Error: Wrong selection. Press Enter to continue.")
+                input("Error: Wrong selection. Press Enter to continue.")
     if telnet_new:
         config["console"]["telnet_selected"] = telnet_new
         if telnet_custom_new:
@@ -435,19 +1978,17 @@ def set_vnc():
 
     while vnc_menu:
         vnc_menu = False
-        os.system("cls" if os.name == "nt" else "clear")
-        print(
-            """Remote Console for GNS3\n"""
-            """=======================\n\n"""
-            """Choose an option:\n""")
+        header = """Remote Console for GNS3\n""" \
+                 """=======================\n\n""" \
+                 """Choose an option:\n\n"""
         if sys.platform.startswith("win"):
-            print(
+            TERMINAL.draw(header +
                 """1) TightVNC\n"""
                 """2) UltraVNC\n"""
                 """3) Custom [%s]\n"""
-                """4) Return to main menu\n""" % config_custom_cmd)
+                """4) Return to main menu\n\n""" % config_custom_cmd)
 
-            vnc_choice = raw_input("Enter your choice [%s]: " % config_console_vnc)
+            vnc_choice = input("Enter your choice [%s]: " % config_console_vnc)
 
             if not vnc_choice:
                 vnc_choice = "4"
@@ -457,22 +1998,22 @@ def set_vnc():
             elif vnc_choice == "2":
                 vnc_new = "UltraVNC"
             elif vnc_choice == "3":
-                vnc_custom_new = raw_input("Enter the custom command: ")
+                vnc_custom_new = input("Enter the custom command: ")
                 vnc_new = "Custom"
             elif vnc_choice == "4":
                 vnc_menu = False
             else:
                 vnc_menu = True
-                raw_input("Error: Wrong selection. Press Enter to continue.")
+                input("Error: Wrong selection. Press Enter to continue.")
 
         else:
-            print(
+            TERMINAL.draw(header +
                 """1) TightVNC\n"""
                 """2) vinagre\n"""
                 """3) gvncviewer\n"""
                 """4) Custom [%s]\n"""
-                """5) Return to main menu\n""" % config_custom_cmd)
-            vnc_choice = raw_input("Enter your choice [%s]: " % config_console_vnc)
+                """5) Return to main menu\n\n""" % config_custom_cmd)
+            vnc_choice = input("Enter your choice [%s]: " % config_console_vnc)
 
             if not vnc_choice:
                 vnc_choice = "5"
@@ -484,13 +2025,13 @@ def set_vnc():
             elif vnc_choice == "3":
                 vnc_new = "gvncviewer"
             elif vnc_choice == "4":
-                vnc_custom_new = raw_input("Enter the custom command: ")
+                vnc_custom_new = input("Enter the custom command: ")
                 vnc_new = "Custom"
             elif vnc_choice == "5":
                 vnc_menu = False
             else:
                 vnc_menu = True
-                raw_input("Error: Wrong selection. Press Enter to continue.")
+                input("Error: Wrong selection. Press Enter to continue.")
     if vnc_new:
         config["console"]["vnc_selected"] = vnc_new
         if vnc_custom_new:
@@ -506,17 +2047,18 @@ def main():
 
     main_menu = True
     while main_menu:
-        # (Re)loading config from file
+        # Saving the changes of the submenus, then (re)loading config from file
+        CONFIG.flush()
         config = load_config()
         config_ip = config["server"]["ip"]
         config_port = config["server"]["port"]
         config_project_name = config["project"]
         config_console_telnet = config["console"]["telnet_selected"]
         config_console_vnc = config["console"]["vnc_selected"]
+        API_CLIENT.configure(config["server"])
 
         # Printing menu that displays the current settings too
-        os.system("cls" if os.name == "nt" else "clear")
-        print(
+        TERMINAL.draw(
             """Remote Console for GNS3\n"""
             """=======================\n\n"""
             """Choose an option:\n"""
@@ -525,14 +2067,15 @@ def main():
             """3) Switch project [%s]\n"""
             """4) Set Telnet client [%s]\n"""
             """5) Set VNC client [%s]\n"""
-            """6) Exit\n""" \
+            """6) Exit\n\n""" \
                 % (config_ip, config_port, config_project_name, \
                    config_console_telnet, config_console_vnc))
-        main_choice = raw_input("Enter your choice: ")
+        main_choice = input("Enter your choice: ")
 
         # Evaluating user choice
         if main_choice == "1":
-            console_connect()
+            if console_connect(): # Exit was chosen in the node menu
+                main_menu = False
         elif main_choice == "2":
             set_server(config_ip, config_port)
         elif main_choice == "3":
@@ -544,7 +2087,321 @@ def main():
         elif main_choice == "6":
             main_menu = False
         else:
-            raw_input("Error: Wrong selection. Press Enter to continue.")
+            input("Error: Wrong selection. Press Enter to continue.")
+
+    wait_for_proxy_clients()
+
+
+# Exit codes of the command line interface
+EXIT_OK = 0
+EXIT_LAUNCH_FAILED = 1 # Some consoles couldn't be opened
+EXIT_USAGE = 2 # Also used by argparse
+EXIT_SERVER_ERROR = 3
+EXIT_NOT_FOUND = 4 # Unknown project or no matching nodes
+
+
+def cli_config(args):
+    """
+    Loads the config and applies the --server and --project overrides of
+    the command line. The overrides aren't saved.
+    """
+
+    if args.config:
+        CONFIG.path = args.config
+    config = load_config()
+    if args.server:
+        ip, _, port = args.server.rpartition(":")
+        if not ip or not port:
+            raise ValueError("--server has to be IP:PORT")
+        config["server"]["ip"] = ip
+        config["server"]["port"] = port
+    if getattr(args, "project", None):
+        config["project"] = args.project
+    API_CLIENT.configure(config["server"])
+    return config
+
+
+def cli_nodes(config):
+    """
+    Fetches the console nodes of the configured project for the commands.
+    Servers that fail are reported, unless all of them fail.
+    """
+
+    servers = configured_servers(config)
+    use_snapshot = config["server"].get("snapshot", True)
+    if use_snapshot:
+        saved_nodes(servers) # Saves the project list request
+    server_nodes = {}
+    nodes, errors = run_core(fetch_servers_console_nodes(servers,
+                                                         config["server"].get("stream_nodes", False),
+                                                         server_nodes))
+    if use_snapshot and nodes is None and servers_error(errors).status != 404:
+        nodes, saved = saved_nodes(servers)
+        if nodes is not None:
+            print("Warning: %s. Using the nodes saved on %s." \
+                  % (servers_error(errors).reason,
+                     time.strftime("%Y-%m-%d %H:%M", time.localtime(saved))), file=sys.stderr)
+            return nodes
+    if nodes is None:
+        raise servers_error(errors)
+    for label, error in errors:
+        print("Warning: %s: %s" % (label, error.reason), file=sys.stderr)
+    if use_snapshot:
+        save_nodes(servers, server_nodes)
+    return nodes
+
+
+def cli_list_projects(args, config):
+    """
+    Prints the projects of the server.
+    """
+
+    servers = configured_servers(config)
+    results = run_core(fan_out(lambda server: API_CLIENT.get_json(server["ip"], server["port"],
+                                                                  "/v2/projects"),
+                               servers))
+    projects = []
+    errors = []
+    for server, server_projects, error in results:
+        if error:
+            errors.append((server_label(server), error))
+            continue
+        for project in server_projects:
+            projects.append({"name": project["name"], "project_id": project["project_id"],
+                             "status": project.get("status"), "server": server_label(server)})
+    if len(errors) == len(servers):
+        raise servers_error(errors)
+    for label, error in errors:
+        print("Warning: %s: %s" % (label, error.reason), file=sys.stderr)
+
+    if args.json:
+        print(json.dumps(projects, indent=4))
+    else:
+        for project in projects:
+            print("%-40s %-10s %s" % (project["name"], project["status"] or "", project["server"]))
+    return EXIT_OK
+
+
+def cli_list_nodes(args, config):
+    """
+    Prints the console nodes of the project.
+    """
+
+    nodes = select_nodes(cli_nodes(config), args.filter, query=args.query)
+    if args.json:
+        print(json.dumps([dict(node._asdict()) for node in nodes], indent=4))
+    else:
+        for node in nodes:
+            print("%-30s %-16s %-8s %s:%s %s" % (node.label, node.node_type, node.console_type,
+                                                 node.host, node.port, node.status))
+    return EXIT_OK if nodes else EXIT_NOT_FOUND
+
+
+def select_nodes(nodes, patterns=None, names=None, query=None):
+    """
+    Returns the nodes whose name matches any of the shell-style patterns or
+    is in "names". Without patterns and names every node is returned. With a
+    query (see NodeIndex.search), only the nodes matching it are considered.
+    """
+
+    if query:
+        nodes = nodes.search(query)
+    if not patterns and not names:
+        return list(nodes)
+    names = set(names or ())
+    return [node for node in nodes if node.name in names or node.label in names \
+            or any(fnmatch.fnmatchcase(node.name, pattern) or fnmatch.fnmatchcase(node.label, pattern) \
+                   for pattern in patterns or ())]
+
+
+def cli_open(args, config):
+    """
+    Opens the consoles of the chosen nodes.
+    """
+
+    nodes = cli_nodes(config)
+    missing = [name for name in args.node or () if nodes.by_name(name) is None]
+    if missing:
+        print("Error: Unknown node(s): %s" % ", ".join(missing), file=sys.stderr)
+        return EXIT_NOT_FOUND
+    if args.all:
+        chosen = select_nodes(nodes, args.filter or ["*"], query=args.query)
+    else:
+        chosen = select_nodes(nodes, args.filter, args.node, args.query)
+    if not chosen:
+        print("Error: No matching nodes.", file=sys.stderr)
+        return EXIT_NOT_FOUND
+
+    probe_timeout = float(config["console"].get("probe_timeout", DEFAULT_PROBE_TIMEOUT))
+    if args.no_probe:
+        probe_timeout = 0
+    alive, skipped = live_nodes(chosen, probe_timeout)
+    jobs, failures = console_jobs(config, alive, console_proxy(config))
+    launcher = ConsoleLauncher(int(config["console"].get("max_parallel_launches",
+                                                         DEFAULT_PARALLEL_LAUNCHES)))
+    failures = skipped + failures + run_core(launcher.launch(jobs))
+    for name, error in failures:
+        print("%s: %s" % (name, error), file=sys.stderr)
+    print("Opened %d of %d console(s)." % (len(chosen) - len(failures), len(chosen)))
+    wait_for_proxy_clients(grace=5)
+    return EXIT_LAUNCH_FAILED if failures else EXIT_OK
+
+
+def cli_search_logs(args, config):
+    """
+    Searches the recorded console sessions.
+    """
+
+    found = False
+    for path, line in search_logs(config["console"].get("session_log_dir", "session_logs"), args.pattern):
+        found = True
+        print("%s: %s" % (path, line.decode("utf-8", "replace")))
+    return EXIT_OK if found else EXIT_NOT_FOUND
+
+
+def cli_relay(args, config):
+    """
+    Runs the caching relay of the configured GNS3 server (see GNS3Relay)
+    until Ctrl-C.
+    """
+
+    interval = args.interval
+    if interval is None:
+        interval = float(config["server"].get("poll_interval", DEFAULT_POLL_INTERVAL))
+    host, _, port = args.listen.rpartition(":")
+    if not port.isdigit():
+        raise ValueError("--listen has to be [HOST:]PORT")
+    relay = GNS3Relay(config["server"]["ip"], config["server"]["port"], interval)
+    try:
+        address = run_core(relay.start(host or "0.0.0.0", port))
+    except OSError as err:
+        raise ValueError("Can't listen on %s: %s" % (args.listen, err))
+    print("Relaying %s:%s on %s:%d, refreshed at most every %g seconds. Press Ctrl-C to stop." \
+          % (relay.gns3_ip, relay.gns3_port, address[0], address[1], interval))
+    sys.stdout.flush()
+    try:
+        while True:
+            sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        run_core(relay.close())
+    print("Answered %d requests with %d requests to the GNS3 server." \
+          % (relay.requests, relay.upstream_requests))
+    return EXIT_OK
+
+
+def add_timing_arguments(parser):
+    """
+    Adds the instrumentation options to a parser. Every command's parser
+    gets them too, so they can be given before or after the command; they
+    have no defaults, not to hide the ones given before the command.
+    """
+
+    parser.add_argument("--timing", action="store_true", default=argparse.SUPPRESS,
+                        help="time the stages of the program and report them at exit")
+    parser.add_argument("--timing-format", choices=TIMING_FORMATS, default=argparse.SUPPRESS,
+                        help="format of the timing report (default: summary); implies --timing")
+    parser.add_argument("--timing-file", metavar="FILE", default=argparse.SUPPRESS,
+                        help="write the timing report to FILE instead of stderr")
+
+
+def timing_arguments(args):
+    """
+    Turns the instrumentation on if it's asked for with --timing or
+    --timing-format, or with the RCON_GNS3_TIMING environment variable (a
+    format, or anything else for the summary). The report's file can also
+    come from RCON_GNS3_TIMING_FILE.
+    """
+
+    report_format = getattr(args, "timing_format", None)
+    if getattr(args, "timing", False) and not report_format:
+        report_format = "summary"
+    report_format = report_format or os.environ.get("RCON_GNS3_TIMING")
+    if report_format:
+        enable_timing(report_format,
+                      getattr(args, "timing_file", None) or os.environ.get("RCON_GNS3_TIMING_FILE"))
+
+
+def cli(argv):
+    """
+    Command line interface for scripts. Without a command the interactive
+    menu is started. Returns the exit code.
+    """
+
+    parser = argparse.ArgumentParser(description="Remote console for GNS3")
+    parser.add_argument("--config", help="config file to use")
+    parser.add_argument("--server", help="GNS3 server as IP:PORT instead of the configured one")
+    add_timing_arguments(parser)
+    commands = parser.add_subparsers(dest="command", metavar="command")
+
+    command = commands.add_parser("list-projects", help="list the projects of the server")
+    command.add_argument("--json", action="store_true", help="print JSON")
+    command.set_defaults(handler=cli_list_projects)
+    add_timing_arguments(command)
+
+    command = commands.add_parser("list-nodes", help="list the nodes with console")
+    command.add_argument("--project", help="project name instead of the configured one")
+    command.add_argument("--filter", action="append", metavar="PATTERN",
+                         help="only nodes matching the shell-style pattern (e.g. 'R*')")
+    command.add_argument("--query", help="only nodes matching the search query "
+                         "(e.g. 'type:dynamips host:10.0.0.5 core')")
+    command.add_argument("--json", action="store_true", help="print JSON")
+    command.set_defaults(handler=cli_list_nodes)
+    add_timing_arguments(command)
+
+    command = commands.add_parser("open", help="open consoles")
+    command.add_argument("--project", help="project name instead of the configured one")
+    command.add_argument("--node", action="append", metavar="NAME", help="node to open")
+    command.add_argument("--all", action="store_true", help="open every (matching) node")
+    command.add_argument("--filter", action="append", metavar="PATTERN",
+                         help="open the nodes matching the shell-style pattern (e.g. 'R*')")
+    command.add_argument("--query", help="open the nodes matching the search query "
+                         "(e.g. 'type:dynamips host:10.0.0.5')")
+    command.add_argument("--no-probe", action="store_true",
+                         help="don't check if the consoles are up before opening them")
+    command.set_defaults(handler=cli_open)
+    add_timing_arguments(command)
+
+    command = commands.add_parser("search-logs", help="search the recorded console sessions")
+    command.add_argument("pattern", help="regular expression")
+    command.set_defaults(handler=cli_search_logs)
+    add_timing_arguments(command)
+
+    command = commands.add_parser("relay", help="serve the GNS3 server's projects and nodes to the "
+                                  "other computers of a group from a cache")
+    command.add_argument("--listen", default="0.0.0.0:%d" % DEFAULT_RELAY_PORT, metavar="[HOST:]PORT",
+                         help="address to listen on (default: 0.0.0.0:%d)" % DEFAULT_RELAY_PORT)
+    command.add_argument("--interval", type=float,
+                         help="seconds between the requests to the GNS3 server (default: poll_interval)")
+    command.set_defaults(handler=cli_relay)
+    add_timing_arguments(command)
+
+    if not set(argv) & (set(commands.choices) | set(["-h", "--help"])):
+        # No command: interactive mode, which only takes the config file
+        interactive_parser = argparse.ArgumentParser(description="Remote console for GNS3")
+        interactive_parser.add_argument("--config", help="config file to use")
+        add_timing_arguments(interactive_parser)
+        args = interactive_parser.parse_args(argv)
+        timing_arguments(args)
+        if args.config:
+            CONFIG.path = args.config
+        main()
+        return EXIT_OK
+
+    args = parser.parse_args(argv)
+    timing_arguments(args)
+    if args.command == "open" and not (args.all or args.node or args.filter or args.query):
+        parser.error("open needs --node, --filter, --query or --all")
+    try:
+        config = cli_config(args)
+        return args.handler(args, config)
+    except ValueError as err:
+        print("Error: %s" % err, file=sys.stderr)
+        return EXIT_USAGE
+    except GNS3APIError as err:
+        print("Error: %s" % err.reason, file=sys.stderr)
+        return EXIT_NOT_FOUND if err.status == 404 else EXIT_SERVER_ERROR
 
 if sys.platform.startswith("win"):
     userprofile = os.path.expandvars("%USERPROFILE%")
@@ -573,21 +2430,20 @@ if sys.platform.startswith("win"):
     }
 
 else:
-    devnull = ' >/dev/null 2>/dev/null &'
-    TELNET_CMD = {'Xterm': 'xterm -T "%d" -e "telnet %h %p"' + devnull,
-                  'Putty': 'putty -telnet %h %p -title "%d" -sl 2500 -fg SALMON1 -bg BLACK' + devnull,
-                  'Gnome Terminal': 'gnome-terminal -t "%d" -e "telnet %h %p"' + devnull,
-                  'Xfce4 Terminal': 'xfce4-terminal --tab -T "%d" -e "telnet %h %p"' + devnull,
-                  'ROXTerm': 'roxterm -n "%d" --tab -e "telnet %h %p"' + devnull,
-                  'KDE Konsole': 'konsole --new-tab -p tabtitle="%d" -e "telnet %h %p"' + devnull,
-                  'SecureCRT': 'SecureCRT /T /N "%d"  /TELNET %h %p' + devnull,
-                  'Mate Terminal': 'mate-terminal --tab -e "telnet %h %p"  -t "%d"' + devnull,
-                  'urxvt': 'urxvt -title %d -e telnet %h %p' + devnull}
-
-    VNC_CMD = {"TightVNC": 'vncviewer %h:%p' + devnull,
-               "Vinagre": 'vinagre %h:%p' + devnull,
-               "gvncviewer": 'gvncviewer %h:%p' + devnull}
+    TELNET_CMD = {'Xterm': 'xterm -T "%d" -e "telnet %h %p"',
+                  'Putty': 'putty -telnet %h %p -title "%d" -sl 2500 -fg SALMON1 -bg BLACK',
+                  'Gnome Terminal': 'gnome-terminal -t "%d" -e "telnet %h %p"',
+                  'Xfce4 Terminal': 'xfce4-terminal --tab -T "%d" -e "telnet %h %p"',
+                  'ROXTerm': 'roxterm -n "%d" --tab -e "telnet %h %p"',
+                  'KDE Konsole': 'konsole --new-tab -p tabtitle="%d" -e "telnet %h %p"',
+                  'SecureCRT': 'SecureCRT /T /N "%d"  /TELNET %h %p',
+                  'Mate Terminal': 'mate-terminal --tab -e "telnet %h %p"  -t "%d"',
+                  'urxvt': 'urxvt -title %d -e telnet %h %p'}
+
+    VNC_CMD = {"TightVNC": 'vncviewer %h:%p',
+               "vinagre": 'vinagre %h:%p',
+               "gvncviewer": 'gvncviewer %h:%p'}
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(cli(sys.argv[1:]))
@@ -0,0 +1,2063 @@
+#
+# Copyright (C) 2018 Andras Dosztal
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+asyncio core of the remote console for GNS3
+
+The GNS3 API client, node parsing, console probing, console launching and
+the caching relay.
+Everything that waits on the network or on other programs is a coroutine
+running on one event loop (see CoreLoop), so node refreshes, probes and
+launches overlap instead of queuing behind each other. The menus in
+rcon_gns3.py are blocking code; they hand the coroutines to the loop with
+run_core().
+"""
+
+import asyncio
+import bisect
+import codecs
+import collections
+import contextlib
+import fnmatch
+import hashlib
+import http
+import json
+import os
+import random
+import re
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+DEFAULT_CONNECT_TIMEOUT = 5
+DEFAULT_READ_TIMEOUT = 30
+DEFAULT_POLL_INTERVAL = 5
+MAX_POLL_INTERVAL = 60
+DEFAULT_PARALLEL_LAUNCHES = 8
+DEFAULT_PROBE_TIMEOUT = 1.0
+DEFAULT_RETRIES = 2 # Extra tries of a request after a transient error
+DEFAULT_RETRY_DELAY = 0.2 # Base of the exponential backoff between the tries
+MAX_RETRY_DELAY = 2.0
+DEFAULT_FAILURE_THRESHOLD = 3 # Failed requests in a row that open a server's circuit
+CIRCUIT_RESET_TIMEOUT = 5.0 # First pause of an open circuit, doubled up to MAX_POLL_INTERVAL
+MAX_PARALLEL_PROBES = 500 # Stays below the usual limit of 1024 open files
+STREAM_LIMIT = 1048576 # Longest header or notification line accepted
+
+
+class CoreLoop(object):
+    """
+    Runs the asyncio event loop of the core in a background thread, so
+    that blocking code (the menus) can use the coroutines of this module:
+    run() waits for the result, submit() returns a concurrent.futures.Future
+    right away. Everything submitted runs side by side on the same loop.
+    """
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._run, name="rcon_gns3 core")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def submit(self, coroutine):
+        """
+        Schedules a coroutine on the loop and returns its Future.
+        """
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def call_soon(self, callback, *args):
+        """
+        Calls a function on the loop's thread.
+        """
+        self.loop.call_soon_threadsafe(callback, *args)
+
+    def run(self, coroutine):
+        """
+        Runs a coroutine on the loop and returns its result (or raises its
+        exception). Ctrl-C cancels the coroutine.
+        """
+
+        future = self.submit(coroutine)
+        try:
+            return future.result()
+        except KeyboardInterrupt:
+            future.cancel()
+            raise
+
+
+CORE_LOOP = None
+
+
+def get_core_loop():
+    """
+    Returns the shared CoreLoop, starting it at the first call.
+    """
+
+    global CORE_LOOP
+    if CORE_LOOP is None:
+        CORE_LOOP = CoreLoop()
+    return CORE_LOOP
+
+
+def run_core(coroutine):
+    """
+    Runs a coroutine of the core from blocking code and returns its result.
+    """
+    return get_core_loop().run(coroutine)
+
+
+class Histogram(object):
+    """
+    Distribution of durations in fixed, roughly logarithmic buckets (in
+    seconds), plus their count, sum, minimum and maximum.
+    """
+
+    BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+               2.5, 5.0, 10.0, 30.0)
+
+    __slots__ = ("counts", "count", "total", "min", "max")
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1) # The last one is +Inf
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, seconds):
+        """
+        Adds a duration.
+        """
+        index = 0
+        while index < len(self.BUCKETS) and seconds > self.BUCKETS[index]:
+            index += 1
+        self.counts[index] += 1
+        self.count += 1
+        self.total += seconds
+        self.min = seconds if self.min is None else min(self.min, seconds)
+        self.max = seconds if self.max is None else max(self.max, seconds)
+
+    def quantile(self, fraction):
+        """
+        Estimates a quantile: the upper bound of the bucket it falls into,
+        but not more than the maximum.
+        """
+        if not self.count:
+            return None
+        seen = 0
+        for bound, count in zip(self.BUCKETS + (self.max,), self.counts):
+            seen += count
+            if seen >= fraction * self.count:
+                return min(bound, self.max)
+        return self.max
+
+
+class Timings(object):
+    """
+    Opt-in instrumentation: a Histogram of durations per stage (project
+    lookup, node fetch, parse, render, launch, etc.). While it isn't
+    enabled, timed() and observe() do nothing, so the instrumented code
+    paths cost next to nothing. Stages may be timed from any thread.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.histograms = collections.OrderedDict() # Stage -> Histogram
+        self._lock = threading.Lock()
+
+    def observe(self, stage, seconds):
+        """
+        Records a duration of a stage.
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            if stage not in self.histograms:
+                self.histograms[stage] = Histogram()
+            self.histograms[stage].observe(seconds)
+
+    @contextlib.contextmanager
+    def timed(self, stage):
+        """
+        Context manager recording how long its block took, even if the
+        block raises.
+        """
+        if not self.enabled:
+            yield
+            return
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.time() - start)
+
+    def summary(self):
+        """
+        Returns a table of the stages for people.
+        """
+        lines = ["%-16s %7s %11s %9s %9s %9s %9s" % ("stage", "count", "total ms", "mean ms",
+                                                    "p50 ms", "p95 ms", "max ms")]
+        with self._lock:
+            for stage, histogram in self.histograms.items():
+                lines.append("%-16s %7d %11.1f %9.2f %9.2f %9.2f %9.2f" % (
+                    stage, histogram.count, histogram.total * 1000,
+                    histogram.total / histogram.count * 1000, histogram.quantile(0.5) * 1000,
+                    histogram.quantile(0.95) * 1000, histogram.max * 1000))
+        return "\n".join(lines) + "\n"
+
+    def as_json(self):
+        """
+        Returns the histograms as a JSON document (times in seconds).
+        """
+        stages = collections.OrderedDict()
+        with self._lock:
+            for stage, histogram in self.histograms.items():
+                buckets = collections.OrderedDict()
+                for bound, count in zip(Histogram.BUCKETS + ("+Inf",), histogram.counts):
+                    buckets[str(bound)] = count
+                stages[stage] = {"count": histogram.count, "sum": histogram.total,
+                                 "min": histogram.min, "max": histogram.max,
+                                 "p50": histogram.quantile(0.5), "p95": histogram.quantile(0.95),
+                                 "buckets": buckets}
+        return json.dumps(stages, indent=4) + "\n"
+
+    def as_prometheus(self):
+        """
+        Returns the histograms in the Prometheus text exposition format.
+        """
+        lines = ["# HELP rcon_gns3_stage_seconds Time spent in the stages of rcon_gns3.",
+                 "# TYPE rcon_gns3_stage_seconds histogram"]
+        with self._lock:
+            for stage, histogram in self.histograms.items():
+                cumulative = 0
+                for bound, count in zip(Histogram.BUCKETS + ("+Inf",), histogram.counts):
+                    cumulative += count
+                    lines.append('rcon_gns3_stage_seconds_bucket{stage="%s",le="%s"} %d' \
+                                 % (stage, bound, cumulative))
+                lines.append('rcon_gns3_stage_seconds_sum{stage="%s"} %r' % (stage, histogram.total))
+                lines.append('rcon_gns3_stage_seconds_count{stage="%s"} %d' % (stage, histogram.count))
+        return "\n".join(lines) + "\n"
+
+    def report(self, report_format="summary"):
+        """
+        Returns the report in the given format: summary, json or prometheus.
+        """
+        if report_format == "json":
+            return self.as_json()
+        if report_format == "prometheus":
+            return self.as_prometheus()
+        return self.summary()
+
+
+TIMINGS = Timings()
+
+
+class GNS3APIError(Exception):
+    """
+    Raised when the GNS3 server can't be reached or answers with an error.
+    "status" is the HTTP status code, or None if there was no answer at all.
+    """
+
+    def __init__(self, reason, status=None):
+        Exception.__init__(self, reason)
+        self.reason = reason
+        self.status = status
+
+
+class GNS3Response(object):
+    """
+    A fully read API response together with the time it took.
+    """
+
+    def __init__(self, status, headers, body, latency):
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.latency = latency
+
+    def json(self):
+        """
+        Decodes the response body.
+        """
+        with TIMINGS.timed("json_decode"):
+            return json.loads(self.body.decode("utf-8"))
+
+
+class CircuitOpenError(GNS3APIError):
+    """
+    Raised without sending the request while a server's circuit is open
+    (see CircuitBreaker).
+    """
+
+
+# Errors of a broken connection or a malformed response
+CONNECTION_ERRORS = (OSError, asyncio.IncompleteReadError, ValueError)
+
+
+def transient_error(err):
+    """
+    Returns whether a GNS3APIError may go away by itself: no answer at all,
+    or the server (or a proxy in front of it) is overloaded or restarting.
+    """
+    return err.status is None or err.status in (502, 503, 504)
+
+
+def backoff_delay(attempt, base=DEFAULT_RETRY_DELAY, cap=MAX_RETRY_DELAY):
+    """
+    Returns how long to wait before the next try: exponential backoff with
+    full jitter, so clients that failed together don't retry together.
+    """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class CircuitBreaker(object):
+    """
+    Health of a GNS3 server as the client sees it. After "threshold"
+    transient errors in a row the circuit opens: requests to the server fail
+    at once with CircuitOpenError instead of piling up on a server that's
+    down or overloaded. After a pause, one request is let through as a
+    trial: if it succeeds the circuit closes, otherwise it opens again for
+    twice as long (at most MAX_POLL_INTERVAL seconds).
+    """
+
+    def __init__(self, threshold=DEFAULT_FAILURE_THRESHOLD, reset_timeout=CIRCUIT_RESET_TIMEOUT):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0 # Transient errors in a row
+        self.opened = None # When the circuit opened, None while it's closed
+        self.pause = reset_timeout
+        self.last_error = None
+        self._trial = False # The trial request is in progress
+
+    def check(self):
+        """
+        Raises CircuitOpenError if no request should be sent now; otherwise
+        the request may go (as the trial if the pause is over).
+        """
+
+        if self.opened is None:
+            return
+        remaining = self.opened + self.pause - time.time()
+        if remaining > 0 or self._trial:
+            raise CircuitOpenError("%s (not trying again for %.0f s)" \
+                                   % (self.last_error.reason, max(remaining, 0)))
+        self._trial = True
+
+    def record(self, error=None):
+        """
+        Records the outcome of a request: None if the server answered, or
+        the transient GNS3APIError.
+        """
+
+        trial, self._trial = self._trial, False
+        if error is None:
+            self.failures = 0
+            self.opened = None
+            self.pause = self.reset_timeout
+            return
+        self.failures += 1
+        self.last_error = error
+        if trial:
+            self.opened = time.time()
+            self.pause = min(self.pause * 2, MAX_POLL_INTERVAL)
+        elif self.opened is None and self.failures >= self.threshold:
+            self.opened = time.time()
+
+    def abandon(self):
+        """
+        The request was cancelled, so there's no outcome to record.
+        """
+        self._trial = False
+
+    def healthy(self):
+        """
+        Returns whether the circuit is closed.
+        """
+        return self.opened is None
+
+
+class GNS3Client(object):
+    """
+    Shared asyncio HTTP client for the GNS3 API.
+
+    Keeps HTTP/1.1 keep-alive connections pooled per (ip, port), so menu
+    refreshes reuse the same TCP connection instead of doing a new handshake
+    every time. Each request takes an idle connection from the pool and
+    returns it once the response is read; a connection whose response wasn't
+    read to its end (error, cancellation) is closed instead. The client has
+    to be used from the core's event loop only.
+
+    Requests that fail with a transient error (see transient_error) are
+    tried again at most "retries" times with jittered exponential backoff.
+    Identical GET requests in progress at the same time are sent only once
+    and share the response. Every server has a CircuitBreaker, so requests
+    to a failing server fail fast until it recovers.
+    """
+
+    def __init__(self, connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+                 read_timeout=DEFAULT_READ_TIMEOUT, retries=DEFAULT_RETRIES,
+                 retry_delay=DEFAULT_RETRY_DELAY, failure_threshold=DEFAULT_FAILURE_THRESHOLD):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.failure_threshold = failure_threshold
+        self.latency = {} # (ip, port) -> (last, count, total) in seconds
+        self._idle = {} # (ip, port) -> list of idle (reader, writer) pairs
+        self._breakers = {} # (ip, port) -> CircuitBreaker
+        self._in_flight = {} # (ip, port, path, headers) -> Future of the GET in progress
+
+    def configure(self, server_config):
+        """
+        Applies the timeouts and the retry settings from the "server"
+        section of the config.
+        """
+        self.connect_timeout = float(server_config.get("connect_timeout", DEFAULT_CONNECT_TIMEOUT))
+        self.read_timeout = float(server_config.get("read_timeout", DEFAULT_READ_TIMEOUT))
+        self.retries = int(server_config.get("retries", DEFAULT_RETRIES))
+        self.retry_delay = float(server_config.get("retry_delay", DEFAULT_RETRY_DELAY))
+        self.failure_threshold = int(server_config.get("failure_threshold", DEFAULT_FAILURE_THRESHOLD))
+        for breaker in self._breakers.values():
+            breaker.threshold = self.failure_threshold
+
+    def breaker(self, gns3_ip, gns3_port):
+        """
+        Returns the CircuitBreaker of a server.
+        """
+        key = (gns3_ip, str(gns3_port))
+        if key not in self._breakers:
+            self._breakers[key] = CircuitBreaker(self.failure_threshold)
+        return self._breakers[key]
+
+    async def _connect(self, key):
+        try:
+            with TIMINGS.timed("connect"): # Name resolution and TCP handshake
+                reader, writer = await asyncio.wait_for(
+                    asyncio.open_connection(key[0], int(key[1]), limit=STREAM_LIMIT),
+                    self.connect_timeout)
+        except asyncio.TimeoutError:
+            raise GNS3APIError("timed out")
+        except OSError as err:
+            raise GNS3APIError(str(err))
+        sock = writer.get_extra_info("socket")
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return reader, writer
+
+    async def _read(self, awaitable):
+        """
+        Waits for a read, at most read_timeout seconds.
+        """
+        try:
+            return await asyncio.wait_for(awaitable, self.read_timeout)
+        except asyncio.TimeoutError:
+            raise GNS3APIError("timed out")
+
+    async def _read_head(self, reader):
+        """
+        Reads the status line and the headers of a response. Returns the
+        status, the reason and the headers with lowercase names.
+        """
+
+        status_line = await self._read(reader.readline())
+        if not status_line:
+            raise ConnectionResetError("The server closed the connection")
+        parts = status_line.decode("latin-1").split(None, 2)
+        if len(parts) < 2 or not parts[1].isdigit():
+            raise ValueError("Invalid status line: %r" % status_line)
+        headers = {}
+        while True:
+            line = await self._read(reader.readline())
+            if not line.strip():
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        reason = parts[2].strip() if len(parts) > 2 else ""
+        return parts[0], int(parts[1]), reason, headers
+
+    async def _send(self, key, method, path, headers):
+        """
+        Sends a request and reads the head of the response. Returns the
+        connection, the status, the reason, the headers and whether the
+        connection can be reused once the body is read. A reused keep-alive
+        connection may have been closed by the server in the meantime, so
+        that case is retried once on a fresh connection.
+        """
+
+        while True:
+            idle = self._idle.get(key)
+            reused = bool(idle)
+            conn = idle.pop() if reused else await self._connect(key)
+            lines = ["%s %s HTTP/1.1" % (method, path), "Host: %s:%s" % key]
+            lines.extend("%s: %s" % header for header in sorted((headers or {}).items()))
+            complete = False
+            try:
+                conn[1].write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+                await conn[1].drain()
+                version, status, reason, response_headers = await self._read_head(conn[0])
+                complete = True
+            except CONNECTION_ERRORS as err:
+                if not reused:
+                    raise GNS3APIError(str(err) or "The connection was closed")
+                continue
+            finally:
+                if not complete:
+                    conn[1].close()
+            connection = response_headers.get("connection", "").lower()
+            keep_alive = connection != "close" and (version != "HTTP/1.0" or connection == "keep-alive") \
+                         and ("content-length" in response_headers \
+                              or "chunked" in response_headers.get("transfer-encoding", "").lower() \
+                              or method == "HEAD" or status in (204, 304))
+            return conn, status, reason, response_headers, keep_alive
+
+    async def _iter_body(self, reader, method, status, headers, chunk_size):
+        """
+        Yields the body of a response in pieces of at most "chunk_size"
+        bytes as they arrive (chunked transfer encoding is undone).
+        """
+
+        if method == "HEAD" or status in (204, 304) or 100 <= status < 200:
+            return
+        if "chunked" in headers.get("transfer-encoding", "").lower():
+            while True:
+                size = int(((await self._read(reader.readline())).split(b";")[0].strip()), 16)
+                if size == 0:
+                    while (await self._read(reader.readline())).strip():
+                        pass # Skipping the trailers
+                    return
+                while size:
+                    piece = await self._read(reader.read(min(size, chunk_size)))
+                    if not piece:
+                        raise ConnectionResetError("The server closed the connection")
+                    size -= len(piece)
+                    yield piece
+                await self._read(reader.readline())
+        elif "content-length" in headers:
+            remaining = int(headers["content-length"])
+            while remaining:
+                piece = await self._read(reader.read(min(remaining, chunk_size)))
+                if not piece:
+                    raise ConnectionResetError("The server closed the connection")
+                remaining -= len(piece)
+                yield piece
+        else:
+            while True:
+                piece = await self._read(reader.read(chunk_size))
+                if not piece:
+                    return
+                yield piece
+
+    def _finish(self, key, conn, keep_alive, start):
+        """
+        Puts the connection back to the pool once the response is fully
+        read and records the latency of the request.
+        """
+
+        if keep_alive:
+            self._idle.setdefault(key, []).append(conn)
+        else:
+            conn[1].close()
+        latency = time.time() - start
+        _, count, total = self.latency.get(key, (0, 0, 0))
+        self.latency[key] = (latency, count + 1, total + latency)
+        return latency
+
+    async def request(self, gns3_ip, gns3_port, path, method="GET", headers=None):
+        """
+        Sends a request and reads the whole response, trying again after
+        transient errors. Raises GNS3APIError on connection errors and
+        non-2xx answers (CircuitOpenError if the server's circuit is open).
+        """
+
+        if method != "GET":
+            return await self._request_retrying(gns3_ip, gns3_port, path, method, headers)
+        flight = (gns3_ip, str(gns3_port), path, tuple(sorted((headers or {}).items())))
+        pending = self._in_flight.get(flight)
+        if pending is None:
+            pending = asyncio.ensure_future(self._request_retrying(gns3_ip, gns3_port, path,
+                                                                   method, headers))
+            self._in_flight[flight] = pending
+            pending.add_done_callback(lambda future: self._landed(flight, future))
+        # One caller giving up (e.g. a timeout) doesn't cancel it for the others
+        return await asyncio.shield(pending)
+
+    def _landed(self, flight, future):
+        self._in_flight.pop(flight, None)
+        if not future.cancelled():
+            future.exception() # Retrieved even if every caller is gone
+
+    async def _request_retrying(self, gns3_ip, gns3_port, path, method, headers):
+        attempt = 0
+        while True:
+            try:
+                return await self._request_once(gns3_ip, gns3_port, path, method, headers)
+            except CircuitOpenError:
+                raise
+            except GNS3APIError as err:
+                if attempt >= self.retries or not transient_error(err):
+                    raise
+            await asyncio.sleep(backoff_delay(attempt, self.retry_delay))
+            attempt += 1
+
+    async def _request_once(self, gns3_ip, gns3_port, path, method, headers):
+        breaker = self.breaker(gns3_ip, gns3_port)
+        breaker.check()
+        try:
+            response = await self._request(gns3_ip, gns3_port, path, method, headers)
+        except GNS3APIError as err:
+            breaker.record(err if transient_error(err) else None)
+            raise
+        except BaseException:
+            breaker.abandon()
+            raise
+        breaker.record()
+        return response
+
+    async def _request(self, gns3_ip, gns3_port, path, method, headers):
+        key = (gns3_ip, str(gns3_port))
+        start = time.time()
+        conn, status, reason, response_headers, keep_alive = await self._send(key, method, path, headers)
+        body = []
+        complete = False
+        try:
+            async for piece in self._iter_body(conn[0], method, status, response_headers, 65536):
+                body.append(piece)
+            complete = True
+        except CONNECTION_ERRORS as err:
+            raise GNS3APIError(str(err) or "The connection was closed")
+        finally:
+            if not complete:
+                conn[1].close()
+        latency = self._finish(key, conn, keep_alive, start)
+
+        if not 200 <= status < 300 and status != 304:
+            raise GNS3APIError("HTTP %d %s" % (status, reason), status)
+        return GNS3Response(status, response_headers, b"".join(body), latency)
+
+    async def stream(self, gns3_ip, gns3_port, path, chunk_size=65536):
+        """
+        GETs an API path and yields the body in chunks as it arrives.
+        Nothing is sent until the first chunk is requested. If the caller
+        stops early, the connection is closed instead of being reused.
+        Raises GNS3APIError on connection errors and non-2xx answers. The
+        server's circuit breaker applies, but a stream isn't tried again:
+        its first chunks may have been used already.
+        """
+
+        key = (gns3_ip, str(gns3_port))
+        breaker = self.breaker(gns3_ip, gns3_port)
+        breaker.check()
+        start = time.time()
+        complete = False
+        try:
+            conn, status, reason, response_headers, keep_alive = await self._send(key, "GET", path, None)
+            try:
+                body = self._iter_body(conn[0], "GET", status, response_headers, chunk_size)
+                if not 200 <= status < 300:
+                    async for _ in body:
+                        pass
+                    complete = True
+                    raise GNS3APIError("HTTP %d %s" % (status, reason), status)
+                async for piece in body:
+                    yield piece
+                complete = True
+            except CONNECTION_ERRORS as err:
+                raise GNS3APIError(str(err) or "The connection was closed")
+            finally:
+                if complete:
+                    self._finish(key, conn, keep_alive, start)
+                else:
+                    conn[1].close()
+        except GNS3APIError as err:
+            breaker.record(err if transient_error(err) else None)
+            raise
+        except BaseException:
+            breaker.abandon()
+            raise
+        if complete:
+            breaker.record()
+
+    async def get_json(self, gns3_ip, gns3_port, path):
+        """
+        GETs an API path and returns the decoded JSON.
+        """
+        return (await self.request(gns3_ip, gns3_port, path)).json()
+
+    async def watch(self, gns3_ip, gns3_port, path):
+        """
+        Follows a GNS3 notification stream on a dedicated connection and
+        yields the notifications as they arrive. HTTP/1.0 is used, so the
+        server sends the JSON documents line by line without chunked
+        encoding. Raises GNS3APIError if the stream isn't available (with
+        the HTTP status) or breaks.
+        """
+
+        reader, writer = await self._connect((gns3_ip, str(gns3_port)))
+        try:
+            writer.write(("GET %s HTTP/1.0\r\nHost: %s:%s\r\n\r\n" \
+                          % (path, gns3_ip, gns3_port)).encode("ascii"))
+            await writer.drain()
+            _, status, reason, _ = await self._read_head(reader)
+            if status != 200:
+                raise GNS3APIError("HTTP %d %s" % (status, reason), status)
+            while True:
+                line = await self._read(reader.readline())
+                if not line:
+                    raise GNS3APIError("The notification stream was closed")
+                if line.strip():
+                    yield json.loads(line.decode("utf-8"))
+        except (OSError, asyncio.IncompleteReadError) as err:
+            raise GNS3APIError(str(err) or "The notification stream was closed")
+        except ValueError as err:
+            raise GNS3APIError("Invalid notification: %s" % err)
+        finally:
+            writer.close()
+
+    def last_latency(self, gns3_ip, gns3_port):
+        """
+        Returns the latency of the last request to the server in milliseconds,
+        or None if there wasn't any yet.
+        """
+        stats = self.latency.get((gns3_ip, str(gns3_port)))
+        if stats:
+            return stats[0] * 1000
+        return None
+
+    def close(self):
+        """
+        Closes all pooled connections.
+        """
+        for idle in self._idle.values():
+            for _, writer in idle:
+                writer.close()
+        self._idle = {}
+
+
+API_CLIENT = GNS3Client()
+
+
+class JSONArrayDecoder(object):
+    """
+    Incrementally decodes a JSON array that arrives in chunks of UTF-8
+    bytes. feed() returns the elements completed by the chunk, close()
+    the last ones. Only the element being decoded is kept in memory, never
+    the whole document. Raises ValueError on invalid or truncated input.
+    """
+
+    def __init__(self):
+        self.done = False # The closing "]" was reached
+        self._decoder = json.JSONDecoder()
+        self._text_decoder = codecs.getincrementaldecoder("utf-8")()
+        self._buf = ""
+        self._started = False
+        self._need_separator = False # An element was decoded, a "," or "]" must follow
+        self._need_element = False # A "," was read, an element must follow
+
+    def feed(self, chunk):
+        """
+        Adds a chunk and returns the list of elements completed by it.
+        """
+        text = self._text_decoder.decode(chunk)
+        if self.done:
+            # Only whitespace may follow the array, close() checks it
+            self._buf = (self._buf + text).strip()[:1]
+            return []
+        self._buf += text
+        return self._parse(False)
+
+    def close(self):
+        """
+        Marks the end of the input and returns the remaining elements.
+        """
+        self._buf += self._text_decoder.decode(b"", True)
+        elements = [] if self.done else self._parse(True)
+        if not self.done:
+            raise ValueError("Truncated JSON array")
+        if self._buf.strip():
+            raise ValueError("Extra data after the JSON array")
+        return elements
+
+    def _parse(self, eof):
+        elements = []
+        buf = self._buf
+        pos = 0
+        while True:
+            while pos < len(buf) and buf[pos] in " \t\r\n":
+                pos += 1
+            if pos >= len(buf):
+                break
+            char = buf[pos]
+            if not self._started:
+                if char != "[":
+                    raise ValueError("Expected a JSON array")
+                self._started = True
+                pos += 1
+                continue
+            if char == "]":
+                if self._need_element:
+                    raise ValueError("Expected a value after ',' at position %d" % pos)
+                self.done = True
+                pos += 1
+                break
+            if self._need_separator:
+                if char != ",":
+                    raise ValueError("Expected ',' or ']' at position %d" % pos)
+                self._need_separator = False
+                self._need_element = True
+                pos += 1
+                continue
+            try:
+                element, end = self._decoder.raw_decode(buf, pos)
+            except ValueError:
+                if eof:
+                    raise
+                break
+            # A delimiter has to follow the element, otherwise it might be
+            # a number that is cut in half by the chunk boundary.
+            if not eof and (end >= len(buf) or buf[end] not in " \t\r\n,]"):
+                break
+            elements.append(element)
+            pos = end
+            self._need_separator = True
+            self._need_element = False
+        self._buf = buf[pos:]
+        return elements
+
+
+def iter_json_array(chunks):
+    """
+    Decodes a JSON array from an iterable of UTF-8 chunks with
+    JSONArrayDecoder and yields its elements one by one.
+    """
+
+    decoder = JSONArrayDecoder()
+    for chunk in chunks:
+        for element in decoder.feed(chunk):
+            yield element
+    for element in decoder.close():
+        yield element
+
+
+def index_projects(projects_json):
+    """
+    Builds a project name -> Project ID dictionary from the project list.
+    """
+
+    return dict((project["name"], project["project_id"]) for project in projects_json)
+
+
+# (ip, port, project name) -> Project ID of every project seen on the server
+PROJECT_ID_CACHE = {}
+
+# (ip, port) -> the last project list of the server
+PROJECTS_CACHE = {}
+
+
+async def request_projects(gns3_ip, gns3_port):
+    """
+    Gets the project list of the GNS3 server, and keeps it and the Project
+    IDs for later. Raises GNS3APIError on errors.
+    """
+
+    projects_json = await API_CLIENT.get_json(gns3_ip, gns3_port, "/v2/projects")
+    PROJECTS_CACHE[(gns3_ip, str(gns3_port))] = projects_json
+    remember_project_ids(gns3_ip, gns3_port, index_projects(projects_json))
+    return projects_json
+
+
+async def lookup_project_id(gns3_ip, gns3_port, gns3_project_name):
+    """
+    Returns the Project ID of the project, only asking the GNS3 server for
+    the project list if it isn't cached yet. Returns None for unknown projects,
+    raises GNS3APIError if the server can't be reached.
+    """
+
+    key = (gns3_ip, str(gns3_port), gns3_project_name)
+    if key not in PROJECT_ID_CACHE:
+        with TIMINGS.timed("project_lookup"):
+            projects_json = await request_projects(gns3_ip, gns3_port)
+        return index_projects(projects_json).get(gns3_project_name)
+    return PROJECT_ID_CACHE[key]
+
+
+def remember_project_ids(gns3_ip, gns3_port, projects_index):
+    """
+    Adds a project name -> Project ID dictionary of the server to the cache,
+    e.g. the one saved last time. A Project ID that turns out to be gone is
+    looked up again (see fetch_console_nodes).
+    """
+
+    for project_name, project_id in projects_index.items():
+        PROJECT_ID_CACHE[(gns3_ip, str(gns3_port), project_name)] = project_id
+
+
+def known_project_ids(gns3_ip, gns3_port):
+    """
+    Returns the cached project name -> Project ID dictionary of the server.
+    """
+
+    return dict((key[2], project_id) for key, project_id in PROJECT_ID_CACHE.items() \
+                if key[:2] == (gns3_ip, str(gns3_port)))
+
+
+def invalidate_project_id(gns3_ip, gns3_port, gns3_project_id):
+    """
+    Drops a Project ID from the cache, e.g. when the project was closed or
+    reloaded under a new ID.
+    """
+
+    for key, project_id in list(PROJECT_ID_CACHE.items()):
+        if key[:2] == (gns3_ip, str(gns3_port)) and project_id == gns3_project_id:
+            del PROJECT_ID_CACHE[key]
+    NODES_CACHE.pop((gns3_ip, str(gns3_port), gns3_project_id), None)
+
+
+# (ip, port, Project ID) -> validators and the last decoded node list
+NODES_CACHE = {}
+
+
+async def request_nodes(gns3_ip, gns3_port, gns3_project_id):
+    """
+    Gets the nodes of the selected project from the GNS3 server using
+    GNS3 API and returns the list of those. Returns None if the project
+    doesn't exist (anymore), raises GNS3APIError on other errors.
+
+    The request is conditional (If-None-Match / If-Modified-Since) when the
+    server sent validators before. If the server doesn't support them, the
+    body's hash is compared instead. Either way, an unchanged node list is
+    not decoded again: the very same list object as last time is returned.
+    """
+
+    url = "/v2/projects/%s/nodes" % gns3_project_id
+    key = (gns3_ip, str(gns3_port), gns3_project_id)
+    cached = NODES_CACHE.get(key)
+    headers = {}
+    if cached:
+        if cached["etag"]:
+            headers["If-None-Match"] = cached["etag"]
+        if cached["last_modified"]:
+            headers["If-Modified-Since"] = cached["last_modified"]
+
+    try:
+        with TIMINGS.timed("node_fetch"):
+            response = await API_CLIENT.request(gns3_ip, gns3_port, url, headers=headers)
+    except GNS3APIError as err:
+        if err.status == 404:
+            invalidate_project_id(gns3_ip, gns3_port, gns3_project_id)
+            return None
+        raise
+    if cached and response.status == 304:
+        return cached["nodes"]
+    digest = hashlib.sha1(response.body).hexdigest()
+    if cached and cached["digest"] == digest:
+        gns3_nodes_json = cached["nodes"]
+    else:
+        gns3_nodes_json = response.json()
+    NODES_CACHE[key] = {"etag": response.headers.get("etag"),
+                        "last_modified": response.headers.get("last-modified"),
+                        "digest": digest,
+                        "nodes": gns3_nodes_json}
+    return gns3_nodes_json
+
+
+def cached_nodes(gns3_ip, gns3_port, gns3_project_id):
+    """
+    Returns the node list request_nodes got last time, or None.
+    """
+
+    cached = NODES_CACHE.get((gns3_ip, str(gns3_port), gns3_project_id))
+    return cached["nodes"] if cached else None
+
+
+async def request_nodes_stream(gns3_ip, gns3_port, gns3_project_id):
+    """
+    Streaming counterpart of request_nodes: the nodes are decoded and
+    parsed one by one while the response is still being read, so the whole
+    node list (with ports, positions, labels, etc.) is never in memory at
+    once. Returns the ConsoleNodes, or None if the project doesn't exist
+    (anymore). Raises GNS3APIError on other errors.
+    """
+
+    url = "/v2/projects/%s/nodes" % gns3_project_id
+    decoder = JSONArrayDecoder()
+    nodes = []
+    received = False
+    try:
+        with TIMINGS.timed("node_fetch"): # Decoding and parsing included
+            async for chunk in API_CLIENT.stream(gns3_ip, gns3_port, url):
+                received = True
+                nodes.extend(iter_parsed_nodes(decoder.feed(chunk)))
+            if received:
+                nodes.extend(iter_parsed_nodes(decoder.close()))
+    except GNS3APIError as err:
+        if err.status == 404:
+            invalidate_project_id(gns3_ip, gns3_port, gns3_project_id)
+            return None
+        raise
+    except ValueError as err:
+        raise GNS3APIError("Invalid node list: %s" % err)
+    return ConsoleNodes(nodes)
+
+
+async def fetch_console_nodes(gns3_ip, gns3_port, gns3_project_name, stream=False, previous=None):
+    """
+    Looks up the project and returns its console nodes as ConsoleNodes
+    (possibly empty). If the cached Project ID is gone, the project list
+    is fetched again once. Raises GNS3APIError if the server can't be
+    reached or the project doesn't exist (status 404).
+
+    "previous" is the result of the last call: if the node list didn't
+    change on the server, it's returned as is without parsing again.
+    """
+
+    for _ in range(2):
+        project_id = await lookup_project_id(gns3_ip, gns3_port, gns3_project_name)
+        if not project_id:
+            break
+        if stream:
+            nodes = await request_nodes_stream(gns3_ip, gns3_port, project_id)
+            if nodes is not None:
+                return nodes
+            continue
+        nodes_json = await request_nodes(gns3_ip, gns3_port, project_id)
+        if nodes_json is None:
+            continue
+        if previous is not None and nodes_json is getattr(previous, "source", None):
+            return previous
+        try:
+            with TIMINGS.timed("parse"):
+                nodes = ConsoleNodes(iter_parsed_nodes(nodes_json))
+        except ValueError as err:
+            raise GNS3APIError("Invalid node list: %s" % err)
+        nodes.source = nodes_json
+        return nodes
+    raise GNS3APIError("Unknown project: %s" % gns3_project_name, 404)
+
+
+def configured_servers(config):
+    """
+    Returns the GNS3 servers to use: the "server" of the config, followed
+    by the ones in the optional "servers" list. Each is a dictionary with
+    "ip", "port", "project" (the config's project unless the server has its
+    own) and "timeout" (how long to wait for its node list, in seconds).
+    """
+
+    default_timeout = float(config["server"].get("connect_timeout", DEFAULT_CONNECT_TIMEOUT)) \
+                      + float(config["server"].get("read_timeout", DEFAULT_READ_TIMEOUT))
+    servers = []
+    for server in [config["server"]] + list(config.get("servers", [])):
+        server = {"ip": server["ip"], "port": str(server["port"]),
+                  "project": server.get("project", config["project"]),
+                  "timeout": float(server.get("timeout", default_timeout))}
+        if (server["ip"], server["port"]) not in [(other["ip"], other["port"]) for other in servers]:
+            servers.append(server)
+    return servers
+
+
+def server_label(server):
+    """
+    Returns "ip:port" of a server from configured_servers.
+    """
+    return "%s:%s" % (server["ip"], server["port"])
+
+
+async def fan_out(function, servers):
+    """
+    Awaits function(server) for every server at once. Returns a list of
+    (server, result, error) triplets in the order of the servers; error is
+    the GNS3APIError raised by the function. A server that doesn't finish
+    within its "timeout" gets an error, without holding up the others.
+    """
+
+    async def call(server):
+        try:
+            return await asyncio.wait_for(function(server), server["timeout"]), None
+        except asyncio.TimeoutError:
+            return None, GNS3APIError("timed out")
+        except GNS3APIError as err:
+            return None, err
+
+    results = await asyncio.gather(*[call(server) for server in servers])
+    return [(server, result, error) for server, (result, error) in zip(servers, results)]
+
+
+async def fetch_servers_console_nodes(servers, stream=False, previous=None):
+    """
+    Fetches the console nodes from all servers at once (see fan_out) and
+    merges them into one ConsoleNodes. With more than one server, every
+    node is tagged with its server. "previous" is a {server label:
+    ConsoleNodes} dictionary of the last results, updated in place, so
+    unchanged node lists aren't parsed again.
+
+    Returns the merged nodes (None if every server failed) and the list of
+    (server label, GNS3APIError) pairs of the failed servers.
+    """
+
+    if previous is None:
+        previous = {}
+
+    def fetch(server):
+        return fetch_console_nodes(server["ip"], server["port"], server["project"],
+                                   stream, previous.get(server_label(server)))
+
+    errors = []
+    for server, nodes, error in await fan_out(fetch, servers):
+        label = server_label(server)
+        if error:
+            errors.append((label, error))
+            continue
+        previous[label] = nodes
+    if len(errors) == len(servers):
+        return None, errors
+    failed = set(label for label, _ in errors)
+    return merge_console_nodes(servers, dict((label, nodes) for label, nodes in previous.items() \
+                                             if label not in failed)), errors
+
+
+def merge_console_nodes(servers, server_nodes):
+    """
+    Merges the {server label: ConsoleNodes} of the servers into one
+    ConsoleNodes in the order of the servers. With more than one server,
+    every node is tagged with its server. Servers without nodes are skipped.
+    """
+
+    merged = []
+    for server in servers:
+        label = server_label(server)
+        nodes = server_nodes.get(label)
+        if nodes is None:
+            continue
+        if len(servers) > 1:
+            merged.extend(node._replace(server=label) for node in nodes)
+        else:
+            merged.extend(nodes)
+    return ConsoleNodes(merged)
+
+
+def servers_error(errors):
+    """
+    Turns the errors of fetch_servers_console_nodes into one GNS3APIError,
+    or None if there weren't any. The status is only kept if it's the same
+    for every server.
+    """
+
+    if not errors:
+        return None
+    if len(errors) == 1:
+        return errors[0][1]
+    statuses = set(error.status for _, error in errors)
+    return GNS3APIError("; ".join("%s: %s" % (label, error.reason) for label, error in errors),
+                        statuses.pop() if len(statuses) == 1 else None)
+
+
+class ConsoleNode(collections.namedtuple("ConsoleNode", \
+                                         "name host port console_type node_type status server")):
+    """
+    Console details of a node:
+        - name (str) - The node's name
+        - host (str) - IP address of the GNS3 server running the node
+        - port (int) - TCP port of the console
+        - console_type (str) - telnet / vnc
+        - node_type (str) - dynamips, qemu, etc.
+        - status (str) - started / stopped / suspended
+        - server (str) - "ip:port" of the GNS3 server the node was listed
+          by if more servers are used, otherwise empty
+    """
+
+    __slots__ = ()
+
+    @property
+    def label(self):
+        """
+        The name shown in the menus; it has the server too if it's set.
+        """
+        if self.server:
+            return "%s [%s]" % (self.name, self.server)
+        return self.name
+
+    def console(self):
+        """
+        Returns the (host, port, type) triplet that identifies the console.
+        """
+        return self.host, self.port, self.console_type
+
+
+class ConsoleNodes(object):
+    """
+    Ordered collection of ConsoleNode records, indexed by label (see
+    ConsoleNode.label), by node name and by console host. Iterating and
+    indexing with a number work like a list; "in" checks the labels.
+    index() gives the search index.
+    """
+
+    __slots__ = ("_nodes", "_by_label", "_by_name", "_by_host", "_index", "source")
+
+    def __init__(self, nodes=()):
+        self.source = None # The decoded node list the records come from
+        self._index = None
+        self._nodes = list(nodes)
+        self._by_label = {}
+        self._by_name = {}
+        self._by_host = {}
+        for node in self._nodes:
+            self._by_label[node.label] = node
+            self._by_name.setdefault(node.name, node)
+            self._by_host.setdefault(node.host, []).append(node)
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def __iter__(self):
+        return iter(self._nodes)
+
+    def __getitem__(self, index):
+        return self._nodes[index]
+
+    def __contains__(self, label):
+        return label in self._by_label
+
+    def __eq__(self, other):
+        return isinstance(other, ConsoleNodes) and self._nodes == other._nodes
+
+    def __ne__(self, other):
+        return not self == other
+
+    def by_name(self, name):
+        """
+        Returns the node with the given label, or the first one with the
+        given name, or None.
+        """
+        return self._by_label.get(name) or self._by_name.get(name)
+
+    def on_host(self, host):
+        """
+        Returns the list of nodes whose console is on the given host.
+        """
+        return list(self._by_host.get(host, ()))
+
+    def hosts(self):
+        """
+        Returns the console hosts.
+        """
+        return list(self._by_host)
+
+    def index(self):
+        """
+        Returns the NodeIndex of the nodes, creating it on first use.
+        """
+        if self._index is None:
+            self._index = NodeIndex(self._nodes)
+        return self._index
+
+    def search(self, query):
+        """
+        Returns the nodes matching the query (see NodeIndex.search).
+        """
+        return [self._nodes[position] for position in self.index().search(query)]
+
+
+# Group keys of the node search -> ConsoleNode field
+GROUP_FIELDS = {"type": "node_type", "host": "host", "console": "console_type",
+                "status": "status", "server": "server"}
+
+
+class NodeIndex(object):
+    """
+    Search index of a node list, built once per ConsoleNodes (see
+    ConsoleNodes.index). The lowercase labels are indexed by their
+    characters and 3 character substrings (trigrams) and kept sorted for
+    prefix search, and the nodes are grouped by node type, console host,
+    console type, status and server. Searches only check the candidates the
+    index gives, so they stay fast with thousands of nodes. Results are node
+    positions in ascending order; searches are case-insensitive. Each part
+    of the index is only built when the first search needs it.
+    """
+
+    def __init__(self, nodes):
+        self.nodes = nodes
+        self.labels = [node.label.lower() for node in nodes]
+        self._grams = None # Character or trigram -> positions of the labels with it
+        self._sorted_labels = None # (label, position) pairs
+        self._groups = None # Group key -> value -> positions
+
+    @property
+    def grams(self):
+        if self._grams is None:
+            grams = collections.defaultdict(list)
+            for position, label in enumerate(self.labels):
+                label_grams = set(label)
+                label_grams.update(label[start:start + 3] for start in range(len(label) - 2))
+                for gram in label_grams:
+                    grams[gram].append(position)
+            self._grams = dict(grams)
+        return self._grams
+
+    @property
+    def sorted_labels(self):
+        if self._sorted_labels is None:
+            self._sorted_labels = sorted(zip(self.labels, range(len(self.labels))))
+        return self._sorted_labels
+
+    @property
+    def groups(self):
+        if self._groups is None:
+            self._groups = dict((key, {}) for key in GROUP_FIELDS)
+            for position, node in enumerate(self.nodes):
+                for key, field in GROUP_FIELDS.items():
+                    self._groups[key].setdefault(str(getattr(node, field)).lower(), []).append(position)
+        return self._groups
+
+    def _containing(self, text):
+        """
+        Returns the set of positions whose label may contain the text: the
+        ones having all its trigrams (or characters if it's shorter).
+        """
+
+        if len(text) < 3:
+            grams = set(text)
+        else:
+            grams = set(text[start:start + 3] for start in range(len(text) - 2))
+        postings = sorted((self.grams.get(gram, ()) for gram in grams), key=len)
+        positions = set(postings[0])
+        for posting in postings[1:]:
+            if not positions:
+                break
+            positions.intersection_update(posting)
+        return positions
+
+    def substring(self, text):
+        """
+        Returns the nodes whose label contains the text.
+        """
+        text = text.lower()
+        if not text:
+            return list(range(len(self.labels)))
+        if len(text) == 1 or (len(text) == 3 and text in self.grams):
+            return list(self.grams.get(text, ())) # Exact already
+        return sorted(position for position in self._containing(text) \
+                      if text in self.labels[position])
+
+    def prefix(self, text):
+        """
+        Returns the nodes whose label starts with the text.
+        """
+        text = text.lower()
+        index = bisect.bisect_left(self.sorted_labels, (text,))
+        positions = []
+        while index < len(self.sorted_labels) and self.sorted_labels[index][0].startswith(text):
+            positions.append(self.sorted_labels[index][1])
+            index += 1
+        return sorted(positions)
+
+    def glob(self, pattern):
+        """
+        Returns the nodes whose whole label matches the shell-style pattern
+        (e.g. "R1*", "*-sw?").
+        """
+
+        pattern = pattern.lower()
+        regex = re.compile(fnmatch.translate(pattern))
+        # The literal parts narrow down the candidates
+        literals = re.split(r"[*?]", re.sub(r"\[[^\]]*\]?", "?", pattern))
+        if literals[0]:
+            candidates = self.prefix(literals[0])
+        elif max(literals, key=len):
+            candidates = sorted(self._containing(max(literals, key=len)))
+        else:
+            candidates = range(len(self.labels))
+        return [position for position in candidates if regex.match(self.labels[position])]
+
+    def fuzzy(self, text):
+        """
+        Returns the nodes whose label has the characters of the text in the
+        same order, not necessarily next to each other (e.g. "r1sw" matches
+        "R1-Switch").
+        """
+
+        text = text.lower()
+        if not text:
+            return list(range(len(self.labels)))
+        positions = self._containing(text[0]) # Every character has to be there
+        for char in set(text[1:]):
+            positions.intersection_update(self.grams.get(char, ()))
+        regex = re.compile(".*?".join(re.escape(char) for char in text))
+        return sorted(position for position in positions if regex.search(self.labels[position]))
+
+    def group(self, key, value):
+        """
+        Returns the nodes of a group (see GROUP_FIELDS), e.g. ("type",
+        "dynamips"). The value may be a shell-style pattern.
+        """
+
+        groups = self.groups[key]
+        value = value.lower()
+        if value in groups:
+            return list(groups[value])
+        positions = []
+        for name in fnmatch.filter(groups, value):
+            positions.extend(groups[name])
+        return sorted(positions)
+
+    def search(self, query):
+        """
+        Returns the nodes matching every word of the query:
+            type:X, host:X, console:X, status:X, server:X - the node group
+            ~text - fuzzy match of the label (see fuzzy)
+            a word with *, ? or [ - shell-style pattern of the whole label
+            anything else - part of the label
+        """
+
+        matches = []
+        for word in query.split():
+            key, colon, value = word.partition(":")
+            if colon and key.lower() in GROUP_FIELDS:
+                matches.append(self.group(key.lower(), value))
+            elif word.startswith("~"):
+                matches.append(self.fuzzy(word[1:]))
+            elif "*" in word or "?" in word or "[" in word:
+                matches.append(self.glob(word))
+            else:
+                matches.append(self.substring(word))
+        if not matches:
+            return list(range(len(self.labels)))
+        matches.sort(key=len)
+        result = matches[0]
+        for positions in matches[1:]:
+            if not result:
+                break
+            positions = set(positions)
+            result = [position for position in result if position in positions]
+        return result
+
+    def summary(self, key):
+        """
+        Returns the (value, node count) pairs of a grouping, the biggest first.
+        """
+        return sorted(((value, len(positions)) for value, positions in self.groups[key].items()),
+                      key=lambda pair: (-pair[1], pair[0]))
+
+
+def iter_parsed_nodes(nodes_json):
+    """
+    Yields the console fields of the applicable nodes one by one as they
+    come from "nodes_json". Only nodes with a console are kept (dynamips,
+    docker, iou, qemu and ethernet_switch).
+    """
+
+    for node in nodes_json:
+        node_type = node["node_type"]
+        if "dynamips" in node_type or "docker" in node_type or "iou" in node_type \
+        or "qemu" in node_type or "ethernet_switch" in node_type:
+            yield ConsoleNode(node["name"], node["console_host"], node["console"],
+                              node["console_type"], node_type, node.get("status", "started"), "")
+
+
+def diff_nodes(old_nodes, new_nodes):
+    """
+    Compares two parsed node lists by node label. Returns three lists of node
+    labels: added nodes, removed nodes and nodes whose console (host, port or
+    type) changed.
+    """
+
+    old_nodes = old_nodes or ConsoleNodes()
+    new_nodes = new_nodes or ConsoleNodes()
+    added = [node.label for node in new_nodes if node.label not in old_nodes]
+    removed = [node.label for node in old_nodes if node.label not in new_nodes]
+    changed = [node.label for node in new_nodes if node.label in old_nodes \
+               and old_nodes.by_name(node.label).console() != node.console()]
+    return added, removed, changed
+
+
+async def probe_consoles(nodes, timeout=DEFAULT_PROBE_TIMEOUT):
+    """
+    Checks whether the consoles of the nodes accept TCP connections. All
+    consoles are probed at once (at most MAX_PARALLEL_PROBES connections
+    are open at a time), every probe waits at most "timeout" seconds from
+    getting its slot, so consoles queued behind slow ones aren't reported
+    down. Nodes that aren't started are not probed.
+
+    Returns a {(host, port): latency} dictionary; the latency is in seconds,
+    or None if the console is down.
+    """
+
+    loop = asyncio.get_event_loop()
+    slots = asyncio.Semaphore(MAX_PARALLEL_PROBES)
+
+    async def probe(host, port):
+        async with slots:
+            start = loop.time()
+            try:
+                _, writer = await asyncio.wait_for(asyncio.open_connection(host, int(port)),
+                                                   timeout)
+            except (OSError, asyncio.TimeoutError):
+                return None
+            writer.close()
+            return loop.time() - start
+
+    consoles = []
+    for node in nodes:
+        console = (node.host, node.port)
+        if node.status == "started" and console not in consoles:
+            consoles.append(console)
+    latencies = await asyncio.gather(*[probe(host, port) for host, port in consoles])
+    return dict(zip(consoles, latencies))
+
+
+class NodePoller(object):
+    """
+    Keeps the console nodes of a project fresh on the core's event loop, so
+    the node menu can be drawn from the latest snapshot without waiting for
+    the GNS3 servers ("servers" comes from configured_servers).
+
+    If "probe_timeout" is set, the consoles are also probed (see
+    probe_consoles) whenever the node list changes or a refresh is
+    requested, and "reachability" holds the latest results. Probing runs
+    next to the polling, so a slow probe doesn't hold up the next refresh.
+
+    If a server provides the project's notification stream, every node
+    notification triggers a refresh and polling is only a safety net.
+    Otherwise the node lists are polled every "interval" seconds. After
+    errors the interval is doubled up to MAX_POLL_INTERVAL (with jitter, so
+    the clients of a failed server don't come back at once), while the last
+    known nodes are kept.
+
+    "initial" is a ConsoleNodes to show until the first successful refresh,
+    e.g. the one saved last time; "stale" is true as long as it's shown.
+    """
+
+    def __init__(self, servers, interval=DEFAULT_POLL_INTERVAL, stream=False, on_change=None,
+                 probe_timeout=None, initial=None):
+        self.servers = servers
+        self.interval = interval
+        self.stream = stream
+        self.on_change = on_change # Called from the core's thread
+        self.probe_timeout = probe_timeout
+        self.reachability = {} # Result of the latest probe_consoles call
+        self.nodes = initial # Latest ConsoleNodes, None until the first success
+        self.stale = initial is not None # The initial nodes weren't refreshed yet
+        self.error = None # GNS3APIError of the latest refresh, if it failed
+        self.updated = threading.Event() # Set once there's something to show
+        if initial is not None:
+            self.updated.set()
+        self._previous = {} # Server label -> its latest ConsoleNodes
+        self._future = None
+        self._wakeup = None # asyncio.Event, created on the loop
+        self._probing = None
+        self._stopped = False
+        self._watching = set() # Labels of the servers sending notifications
+
+    def start(self):
+        """
+        Starts polling, and following the notifications of every server.
+        """
+        self._future = get_core_loop().submit(self._run())
+
+    def stop(self):
+        """
+        Stops polling.
+        """
+        self._stopped = True
+        if self._future:
+            self._future.cancel()
+
+    def refresh_now(self):
+        """
+        Asks for a refresh without waiting for the poll interval.
+        """
+        get_core_loop().call_soon(self._wake)
+
+    def _wake(self):
+        if self._wakeup:
+            self._wakeup.set()
+
+    def wait(self):
+        """
+        Waits for the first refresh (unless there are initial nodes), then
+        returns the (nodes, error) snapshot.
+        The loop keeps the wait interruptible with Ctrl-C.
+        """
+        while not self.updated.is_set():
+            self.updated.wait(0.1)
+        return self.nodes, self.error
+
+    def server_nodes(self):
+        """
+        Returns the {server label: ConsoleNodes} of the servers that answered.
+        """
+        return dict(self._previous)
+
+    def _publish(self, nodes, error, fresh=True):
+        changed = self.updated.is_set() and nodes != self.nodes
+        if self.nodes is not None and nodes == self.nodes:
+            # The same snapshot stays, so the menu can tell changes by identity
+            nodes = self.nodes
+        self.nodes, self.error = nodes, error
+        if fresh:
+            self.stale = False
+        self.updated.set()
+        if changed and self.on_change and not self._stopped:
+            self.on_change()
+
+    async def _run(self):
+        self._wakeup = asyncio.Event()
+        watchers = [asyncio.ensure_future(self._watch(server)) for server in self.servers]
+        try:
+            await self._poll()
+        finally:
+            for watcher in watchers:
+                watcher.cancel()
+            if self._probing:
+                self._probing.cancel()
+
+    async def _poll(self):
+        delay = self.interval
+        probe = True
+        while not self._stopped:
+            nodes, errors = await fetch_servers_console_nodes(self.servers, self.stream, self._previous)
+            if nodes is None:
+                self._publish(self.nodes, servers_error(errors), fresh=False)
+                delay = min(delay * 2, MAX_POLL_INTERVAL)
+            else:
+                if nodes != self.nodes:
+                    probe = True
+                self._publish(nodes, servers_error(errors))
+                if errors:
+                    delay = min(delay * 2, MAX_POLL_INTERVAL)
+                elif len(self._watching) == len(self.servers):
+                    delay = MAX_POLL_INTERVAL
+                else:
+                    delay = self.interval
+                if probe and self.probe_timeout:
+                    if self._probing:
+                        self._probing.cancel()
+                    self._probing = asyncio.ensure_future(self._probe(nodes))
+            try:
+                await asyncio.wait_for(self._wakeup.wait(),
+                                       random.uniform(delay / 2, delay) if delay > self.interval else delay)
+                probe = True
+            except asyncio.TimeoutError:
+                probe = False
+            self._wakeup.clear()
+
+    async def _probe(self, nodes):
+        self.reachability = await probe_consoles(nodes, self.probe_timeout)
+
+    async def _watch(self, server):
+        label = server_label(server)
+        delay = self.interval
+        while not self.updated.is_set() or self.stale:
+            await asyncio.sleep(0.1)
+        while not self._stopped:
+            try:
+                project_id = await lookup_project_id(server["ip"], server["port"], server["project"])
+                if project_id:
+                    path = "/v2/projects/%s/notifications" % project_id
+                    async for notification in API_CLIENT.watch(server["ip"], server["port"], path):
+                        self._watching.add(label)
+                        delay = self.interval
+                        if notification.get("action", "").startswith("node."):
+                            self._wakeup.set()
+            except GNS3APIError as err:
+                if err.status and err.status != 404 and label not in self._watching:
+                    return # Notifications aren't supported, polling only
+            self._watching.discard(label)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, MAX_POLL_INTERVAL)
+
+
+DEFAULT_RELAY_PORT = 3080
+RELAY_NODES_PATH = re.compile(r"^/v2/projects/([^/]+)/nodes$")
+
+
+def relay_node(node):
+    """
+    Returns the fields of a ConsoleNode the way the GNS3 API names them.
+    """
+    return {"name": node.name, "console_host": node.host, "console": node.port,
+            "console_type": node.console_type, "node_type": node.node_type,
+            "status": node.status}
+
+
+class GNS3Relay(object):
+    """
+    Caching relay of the GNS3 API for group sessions: one computer runs it
+    and the others use it as their GNS3 server, without any other change.
+    It answers the requests rcon_gns3 makes (the project list and the node
+    lists) from a cache that is refreshed from the GNS3 server at most once
+    per "interval" seconds, however many clients ask. Concurrent requests
+    of the same path wait for the same upstream request.
+
+    The node lists are sent pre-filtered: only the nodes with a console and
+    only their console fields, with an ETag, so an unchanged list costs the
+    clients a 304 answer. If the GNS3 server can't be reached, the last
+    known answers are served. Notification streams aren't relayed (501),
+    so the clients poll.
+
+    Only the project list and the node lists are cached. Error answers
+    (e.g. a mistyped project ID) are kept apart, at most MAX_ERROR_ENTRIES
+    of them, so nobody can grow the cache without limit.
+    """
+
+    MAX_ERROR_ENTRIES = 256
+
+    def __init__(self, gns3_ip, gns3_port, interval=DEFAULT_POLL_INTERVAL):
+        self.gns3_ip = gns3_ip
+        self.gns3_port = str(gns3_port)
+        self.interval = interval
+        self.requests = 0 # Requests answered
+        self.upstream_requests = 0 # Requests sent to the GNS3 server
+        self._cache = {} # Path -> {"status", "body", "etag", "fetched", "source"} of a 200 answer
+        self._errors = collections.OrderedDict() # Path -> error answer, the oldest first
+        self._pending = {} # Path -> Future of the refresh in progress
+        self._server = None
+
+    async def start(self, host, port):
+        """
+        Starts listening; returns the (host, port) it listens on.
+        """
+        self._server = await asyncio.start_server(self._serve, host, int(port), limit=STREAM_LIMIT)
+        return self._server.sockets[0].getsockname()[:2]
+
+    async def close(self):
+        """
+        Stops listening.
+        """
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+
+    async def get(self, path):
+        """
+        Returns the cached answer of a path, refreshing it first if it's
+        older than the interval.
+        """
+
+        if path != "/v2/projects" and not RELAY_NODES_PATH.match(path):
+            return self._answer(501, "Not supported by the relay")
+        entry = self._cache.get(path) or self._errors.get(path)
+        if entry and time.time() - entry["fetched"] < self.interval:
+            return entry
+        pending = self._pending.get(path)
+        if pending is None:
+            pending = asyncio.ensure_future(self._refresh(path, entry))
+            self._pending[path] = pending
+            pending.add_done_callback(lambda _: self._pending.pop(path, None))
+        # A client that hangs up doesn't cancel the refresh the others wait for
+        return await asyncio.shield(pending)
+
+    async def _refresh(self, path, entry):
+        match = RELAY_NODES_PATH.match(path)
+        self.upstream_requests += 1
+        try:
+            if match:
+                nodes_json = await request_nodes(self.gns3_ip, self.gns3_port, match.group(1))
+                if nodes_json is None:
+                    return self._store(path, 404, "Unknown project")
+                if entry and entry["source"] is nodes_json:
+                    entry["fetched"] = time.time()
+                    return entry
+                try:
+                    with TIMINGS.timed("parse"):
+                        nodes = [relay_node(node) for node in iter_parsed_nodes(nodes_json)]
+                except ValueError as err:
+                    raise GNS3APIError("Invalid node list: %s" % err)
+                body = json.dumps(nodes, separators=(",", ":")).encode("utf-8")
+                return self._store(path, 200, body, nodes_json)
+            response = await API_CLIENT.request(self.gns3_ip, self.gns3_port, path)
+            return self._store(path, 200, response.body)
+        except GNS3APIError as err:
+            if entry and entry["status"] == 200:
+                entry["fetched"] = time.time() # Stale, tried again after the interval
+                return entry
+            return self._store(path, 404 if err.status == 404 else 502, err.reason)
+
+    @staticmethod
+    def _answer(status, body, source=None):
+        if status != 200:
+            body = json.dumps({"status": status, "message": body}).encode("utf-8")
+        return {"status": status, "body": body, "source": source, "fetched": time.time(),
+                "etag": '"%s"' % hashlib.sha1(body).hexdigest()}
+
+    def _store(self, path, status, body, source=None):
+        entry = self._answer(status, body, source)
+        self._errors.pop(path, None)
+        if status == 200:
+            self._cache[path] = entry
+        else:
+            self._cache.pop(path, None)
+            self._errors[path] = entry
+            while len(self._errors) > self.MAX_ERROR_ENTRIES:
+                self._errors.popitem(last=False)
+        return entry
+
+    async def _serve(self, reader, writer):
+        """
+        Answers the requests of a client connection (HTTP/1.1 keep-alive).
+        """
+
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if not line.strip():
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                parts = request_line.decode("latin-1").split()
+                if len(parts) != 3:
+                    break
+                method, path, version = parts
+                keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+                self.requests += 1
+                if method in ("GET", "HEAD"):
+                    entry = await self.get(path.split("?")[0])
+                    status, body = entry["status"], entry["body"]
+                    response_headers = [("Content-Type", "application/json"), ("ETag", entry["etag"])]
+                    if status == 200 and headers.get("if-none-match") == entry["etag"]:
+                        status, body = 304, b""
+                else:
+                    status, body = 405, b""
+                    response_headers = [("Allow", "GET, HEAD")]
+                response_headers.append(("Content-Length", str(len(body))))
+                if not keep_alive:
+                    response_headers.append(("Connection", "close"))
+                head = ["HTTP/1.1 %d %s" % (status, http.HTTPStatus(status).phrase)]
+                head.extend("%s: %s" % header for header in response_headers)
+                writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1"))
+                if method != "HEAD":
+                    writer.write(body)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (OSError, asyncio.IncompleteReadError, ValueError):
+            pass # The client is gone or sent garbage
+        finally:
+            writer.close()
+
+
+class ConsoleRegistry(object):
+    """
+    The console programs started by the launcher, by a (server, project,
+    node name) key, so that a node's console isn't opened twice and the
+    consoles can be closed or reopened together. A key stays known after
+    its program exits (see launched()).
+
+    While programs are running, the core loop polls them every
+    REAP_INTERVAL seconds without waiting for them, so the exited ones
+    don't stay zombies; reap() tells the menu how many have exited.
+    """
+
+    REAP_INTERVAL = 1.0
+
+    def __init__(self):
+        self._lock = threading.Lock() # The menu and the core loop both poll
+        self._processes = {} # Key -> Popen, None once it has exited or was closed
+        self._closing = [] # Closed programs that haven't exited yet
+        self._exited = 0 # Programs that exited since the last reap()
+        self._reaping = False
+
+    def __len__(self):
+        return len(self._processes)
+
+    def add(self, key, process):
+        """
+        Registers the program started for a key. Runs on the core loop.
+        """
+
+        with self._lock:
+            self._processes[key] = process
+        if not self._reaping:
+            self._reaping = True
+            asyncio.get_event_loop().call_later(self.REAP_INTERVAL, self._reap_later)
+
+    def _poll(self):
+        for key, process in self._processes.items():
+            if process is not None and process.poll() is not None:
+                self._processes[key] = None
+                self._exited += 1
+        self._closing = [process for process in self._closing if process.poll() is None]
+
+    def _reap_later(self):
+        with self._lock:
+            self._poll()
+            running = self._closing or any(process is not None \
+                                           for process in self._processes.values())
+        if running:
+            asyncio.get_event_loop().call_later(self.REAP_INTERVAL, self._reap_later)
+        else:
+            self._reaping = False
+
+    def reap(self):
+        """
+        Collects the programs that have exited; returns how many consoles
+        were closed by the user since the last call.
+        """
+
+        with self._lock:
+            self._poll()
+            exited, self._exited = self._exited, 0
+        return exited
+
+    def is_open(self, key):
+        """
+        Returns True if the console of the key is running.
+        """
+        return self._processes.get(key) is not None
+
+    def launched(self, key):
+        """
+        Returns True if a console was ever started for the key.
+        """
+        return key in self._processes
+
+    def close(self, keys):
+        """
+        Stops the running consoles of the keys, with everything they
+        started (e.g. the telnet client in a terminal window). Returns the
+        number of consoles stopped.
+        """
+
+        closed = 0
+        with self._lock:
+            for key in keys:
+                process = self._processes.get(key)
+                if process is None:
+                    continue
+                try:
+                    if sys.platform.startswith("win"):
+                        process.terminate()
+                    else:
+                        # The launcher starts every console in its own session
+                        os.killpg(process.pid, signal.SIGTERM)
+                except OSError:
+                    pass # Exited meanwhile
+                self._processes[key] = None
+                self._closing.append(process)
+                closed += 1
+        return closed
+
+
+# The consoles started in this session
+CONSOLES = ConsoleRegistry()
+
+
+class ConsoleLauncher(object):
+    """
+    Starts console programs without a shell, several at a time.
+
+    A launch is in progress until the program has been running for
+    "check_time" seconds; at most "max_parallel" launches are in progress
+    at once. A launch fails if the program can't be started or exits with
+    an error during that time. Launches are spaced out by a delay that
+    starts at "min_delay", doubles after every failure (the terminal
+    emulator may be overwhelmed) and halves after every success, up to
+    "max_delay".
+    """
+
+    def __init__(self, max_parallel=DEFAULT_PARALLEL_LAUNCHES,
+                 min_delay=0.02, max_delay=1.0, check_time=0.25):
+        self.max_parallel = max(1, max_parallel)
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.check_time = check_time
+        self.delay = min_delay
+        self._next_launch = 0
+
+    def _adapt(self, success):
+        if success:
+            self.delay = max(self.min_delay, self.delay / 2)
+        else:
+            self.delay = min(self.max_delay, self.delay * 2)
+
+    def start(self, argv):
+        """
+        Starts one program detached from the menu's terminal and returns
+        the Popen object. On Windows it gets a console window of its own
+        (like "start" did), which console clients such as "telnet" need;
+        GUI programs don't get a console either way.
+        """
+
+        if sys.platform.startswith("win"):
+            return subprocess.Popen(argv, creationflags=subprocess.CREATE_NEW_CONSOLE)
+        with open(os.devnull, "r+b") as devnull:
+            return subprocess.Popen(argv, stdin=devnull, stdout=devnull, stderr=devnull,
+                                    close_fds=True, start_new_session=True)
+
+    async def _launch(self, name, argv, key, slots, failures):
+        """
+        Starts one job once a slot is free and its turn has come, registers
+        it in CONSOLES if it has a key, then watches it for "check_time"
+        seconds.
+        """
+
+        loop = asyncio.get_event_loop()
+        async with slots:
+            now = loop.time()
+            start = max(now, self._next_launch)
+            self._next_launch = start + self.delay
+            await asyncio.sleep(start - now)
+            started = time.time()
+            try:
+                with TIMINGS.timed("launch_spawn"):
+                    process = self.start(argv)
+            except (OSError, ValueError) as err:
+                failures.append((name, str(err)))
+                self._adapt(False)
+                return
+            if key is not None:
+                CONSOLES.add(key, process)
+            deadline = loop.time() + self.check_time
+            while True:
+                returncode = process.poll()
+                if returncode:
+                    failures.append((name, "exited with code %d" % returncode))
+                    self._adapt(False)
+                    break
+                if returncode == 0 or loop.time() >= deadline:
+                    self._adapt(True)
+                    break
+                await asyncio.sleep(0.005)
+            TIMINGS.observe("launch", time.time() - started)
+
+    async def launch(self, jobs, keys=None):
+        """
+        Starts the (name, argv) jobs and returns the list of (name, error)
+        pairs of the failed ones, in the order of the jobs. "keys" maps job
+        names to ConsoleRegistry keys; those programs are registered in
+        CONSOLES.
+        """
+
+        jobs = list(jobs)
+        keys = keys or {}
+        failures = []
+        slots = asyncio.Semaphore(self.max_parallel)
+        self._next_launch = asyncio.get_event_loop().time()
+        await asyncio.gather(*[self._launch(name, argv, keys.get(name), slots, failures) \
+                               for name, argv in jobs])
+
+        order = dict((name, i) for i, (name, _) in enumerate(jobs))
+        failures.sort(key=lambda failure: order[failure[0]])
+        return failures